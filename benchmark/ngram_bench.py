@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+"""
+n-gram 類似検索 (ngram.NgramIndex) と simstring の再現率・応答時間の比較
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda', 'py'))
+import ngram
+
+NOISE_CHARS = 'アイウエオカキクケコサシスセソタチツテトナニヌネノハヒフヘホマミムメモラリルレロンー'
+
+def add_noise(name, rand, rate=0.2):
+    """ 1文字ずつ、rate の確率で 削除・置換・挿入 のどれかを行う """
+    chars = []
+    for char in name:
+        if rand.random() >= rate:
+            chars.append(char)
+            continue
+        operation = rand.randrange(3)
+        if operation == 1:
+            chars.append(rand.choice(NOISE_CHARS))
+        elif operation == 2:
+            chars.extend([char, rand.choice(NOISE_CHARS)])
+    return ''.join(chars) or name
+
+def percentile(values, ratio):
+    """ パーセンタイル (最近傍) """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * ratio))]
+
+def timed_search(searcher, queries, alpha):
+    """ 各クエリの結果と所要時間(ms)を得る """
+    results = []
+    elapsed = []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(searcher.ranked_search(query, alpha))
+        elapsed.append((time.perf_counter() - start) * 1000)
+    return results, elapsed
+
+def load_simstring(keys):
+    """ simstring の検索器を作る。入っていなければ None """
+    try:
+        from simstring.feature_extractor.character_ngram import CharacterNgramFeatureExtractor
+        from simstring.database.dict import DictDatabase
+        from simstring.measure.jaccard import JaccardMeasure
+        from simstring.searcher import Searcher
+    except ImportError:
+        return None
+    database = DictDatabase(CharacterNgramFeatureExtractor(2))
+    for key in keys:
+        database.add(key)
+    return Searcher(database, JaccardMeasure())
+
+def main():
+    """ main """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--database", help="database json file", type=str,
+                        default=os.path.join('lambda', 'py', 'data', 'database.json'))
+    parser.add_argument("-n", "--queries", help="number of queries per item type", type=int, default=500)
+    parser.add_argument("--alpha", help="similarity threshold", type=float, default=0.3)
+    parser.add_argument("--noise", help="noise rate per character", type=float, default=0.2)
+    parser.add_argument("--seed", help="random seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with open(args.database, 'rt', encoding='utf-8') as file_pointer:
+        data_base = json.load(file_pointer)
+    rand = random.Random(args.seed)
+
+    print('type\tkeys\tbuild_ms\tp50_ms\tp95_ms\tsimstring_build_ms\tsimstring_p50_ms'
+          '\tsimstring_p95_ms\trecall\ttop1_agree')
+    for item_type in ['artist', 'album', 'title']:
+        keys = list(data_base[item_type].keys())
+        if not keys:
+            continue
+        queries = [add_noise(rand.choice(keys), rand, args.noise) for _ in range(args.queries)]
+
+        start = time.perf_counter()
+        index = ngram.NgramIndex(keys)
+        build_ms = (time.perf_counter() - start) * 1000
+        results, elapsed = timed_search(index, queries, args.alpha)
+        row = [item_type, len(keys), build_ms, percentile(elapsed, 0.5), percentile(elapsed, 0.95)]
+
+        start = time.perf_counter()
+        simstring_searcher = load_simstring(keys)
+        simstring_build_ms = (time.perf_counter() - start) * 1000
+        if simstring_searcher is None:
+            row.extend(['-'] * 5)
+        else:
+            expected, simstring_elapsed = timed_search(simstring_searcher, queries, args.alpha)
+            found = 0
+            total = 0
+            top1 = 0
+            for result, reference in zip(results, expected):
+                reference_keys = {key for _, key in reference}
+                found += len(reference_keys & {key for _, key in result})
+                total += len(reference_keys)
+                if (result[0][1] if result else None) == (reference[0][1] if reference else None):
+                    top1 += 1
+            row.extend([simstring_build_ms, percentile(simstring_elapsed, 0.5),
+                        percentile(simstring_elapsed, 0.95),
+                        found / total if total else 1.0, top1 / len(queries)])
+        print('\t'.join('{:.3f}'.format(v) if isinstance(v, float) else str(v) for v in row))
+    return True
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+"""
+musicdb/genlibrary.py で作ったライブラリで、
+genlibrary → musiclist2json → makelanguagemodel → MusicDb の読み込み → 検索
+の各段階の時間と最大メモリを規模ごとに測る
+
+各段階は別プロセスで動かして、os.wait4 でそのプロセスだけの最大 RSS を得る
+"""
+
+import argparse
+import os
+import random
+import subprocess
+import sys
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.join(BENCHMARK_DIR, '..')
+
+def run(command):
+    """ コマンドを動かして (秒, 最大RSS KB) を得る """
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status) if hasattr(os, 'waitstatus_to_exitcode') else status
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, command)
+    return time.perf_counter() - start, usage.ru_maxrss
+
+def search_stage(data_dir, queries, seed):
+    """ (子プロセス) data_dir のデータベースを読んで検索する """
+    sys.path.insert(0, os.path.join(ROOT_DIR, 'lambda', 'py'))
+    sys.path.insert(0, BENCHMARK_DIR)
+    import musicdb # pylint: disable=import-outside-toplevel
+    from ngram_bench import add_noise # pylint: disable=import-outside-toplevel
+    musicdb.DATA_DIR = data_dir
+    musicdb.SNAPSHOT_PATH = os.path.join(data_dir, 'database.snap')
+    musicdb.JSON_PATH = os.path.join(data_dir, 'database.json')
+    musicdb.NGRAM_PATH = os.path.join(data_dir, 'ngram.db')
+
+    start = time.perf_counter()
+    music_db = musicdb.MusicDb()
+    music_db.get_version()
+    load_ms = (time.perf_counter() - start) * 1000
+
+    rand = random.Random(seed)
+    start = time.perf_counter()
+    for item_type in ['artist', 'album', 'title']:
+        keys = list(music_db.data_base[item_type].keys())
+        for _ in range(queries):
+            music_db.get_entry_by_name(item_type, add_noise(rand.choice(keys), rand))
+    search_ms = (time.perf_counter() - start) * 1000 / (queries * 3)
+    print('{:.3f}\t{:.3f}'.format(load_ms, search_ms))
+
+def main():
+    """ main """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--sizes", help="comma separated numbers of titles", type=str, default='1000,10000,100000')
+    parser.add_argument("-w", "--work", help="work directory", type=str, default='benchmark-work')
+    parser.add_argument("-q", "--queries", help="number of search queries per item type", type=int, default=200)
+    parser.add_argument("--seed", help="random seed", type=int, default=0)
+    parser.add_argument("--shards", help="number of snapshot shards", type=int, default=0)
+    parser.add_argument("--search_stage", help=argparse.SUPPRESS, type=str)
+    args = parser.parse_args()
+
+    if args.search_stage:
+        search_stage(args.search_stage, args.queries, args.seed)
+        return True
+
+    python = sys.executable
+    print('titles\tstage\tseconds\tmaxrss_kb')
+    for size in [int(size) for size in args.sizes.split(',')]:
+        work = os.path.join(args.work, str(size))
+        data_dir = os.path.join(work, 'data')
+        os.makedirs(data_dir, exist_ok=True)
+        library = os.path.join(work, 'library.txt')
+        translate = os.path.join(work, 'translate.json')
+        music_list = os.path.join(work, 'list.json')
+        stages = [
+            ('genlibrary', [python, os.path.join(ROOT_DIR, 'musicdb', 'genlibrary.py'),
+                            '-n', str(size), '-o', library, '-d', translate, '--seed', str(args.seed)]),
+            ('musiclist2json', [python, os.path.join(ROOT_DIR, 'musicdb', 'musiclist2json.py'),
+                                '-l', library, '-d', translate, '-o', music_list, '--path_parser', 'posix']),
+            ('makelanguagemodel', [python, os.path.join(ROOT_DIR, 'makelanguagemodel.py'),
+                                   '-i', music_list, '-o', os.path.join(work, 'model.json'), '-s', 'benchmark',
+                                   '-d', os.path.join(data_dir, 'database.json'),
+                                   '--snapshot', os.path.join(data_dir, 'database.snap'),
+                                   '--shards', str(args.shards)]),
+        ]
+        for name, command in stages:
+            seconds, maxrss = run(command)
+            print('{}\t{}\t{:.3f}\t{}'.format(size, name, seconds, maxrss))
+            sys.stdout.flush()
+
+        for musicdb_format in ['snapshot', 'json']:
+            os.environ['MUSICDB_FORMAT'] = musicdb_format
+            command = [python, os.path.abspath(__file__), '--search_stage', data_dir,
+                       '-q', str(args.queries), '--seed', str(args.seed)]
+            start = time.perf_counter()
+            process = subprocess.Popen(command, stdout=subprocess.PIPE)
+            output = process.stdout.read().decode('utf-8').split()
+            _, _, usage = os.wait4(process.pid, 0)
+            seconds = time.perf_counter() - start
+            print('{}\tload_{}\t{:.3f}\t{}'.format(size, musicdb_format, float(output[0]) / 1000, usage.ru_maxrss))
+            print('{}\tsearch_{}_per_query\t{:.6f}\t-'.format(size, musicdb_format, float(output[1]) / 1000))
+            print('{}\tsearch_{}_process\t{:.3f}\t{}'.format(size, musicdb_format, seconds, usage.ru_maxrss))
+            sys.stdout.flush()
+        os.environ.pop('MUSICDB_FORMAT', None)
+    return True
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+"""
+testevents/*.json と、データベースの名前にノイズを入れた PlayMusicIntent を
+スキルに流して、import 時間・ハンドラごとと検索の段階ごとの応答時間・メモリを測る
+
+永続属性は DynamoDB の代わりにメモリ上のアダプタに置くので、AWS 無しで動く
+"""
+
+import argparse
+import copy
+import glob
+import json
+import os
+import random
+import resource
+import sys
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, '..', 'lambda', 'py'))
+sys.path.insert(0, BENCHMARK_DIR)
+
+from ngram_bench import add_noise, percentile
+
+TEMPLATE_EVENT = os.path.join(BENCHMARK_DIR, '..', 'testevents', 'PlayMusic_artsit_with_id.json')
+
+class MemoryPersistenceAdapter:
+    """ DynamoDbAdapter の代わりにメモリに置くアダプタ """
+    def __init__(self):
+        self.items = {}
+        self.calls = {'get': 0, 'save': 0, 'update': 0, 'delete': 0}
+
+    @staticmethod
+    def _key(request_envelope):
+        return request_envelope.context.system.user.user_id
+
+    def get_attributes(self, request_envelope):
+        """ 属性を読む """
+        self.calls['get'] += 1
+        return copy.deepcopy(self.items.get(self._key(request_envelope), {}))
+
+    def save_attributes(self, request_envelope, attributes):
+        """ 属性を書く """
+        self.calls['save'] += 1
+        self.items[self._key(request_envelope)] = copy.deepcopy(attributes)
+
+    def update_attributes(self, request_envelope, attributes, name, values, removed=(), volatile=()):
+        """ attributes[name] の一部だけを書く。volatile はぶつからないので使わない """
+        item = self.items.get(self._key(request_envelope), None)
+        if not item or name not in item:
+            return False
+        self.calls['update'] += 1
+        item[name].update(copy.deepcopy(values))
+        for field in removed:
+            item[name].pop(field, None)
+        return True
+
+    def delete_attributes(self, request_envelope):
+        """ 属性を消す """
+        self.calls['delete'] += 1
+        self.items.pop(self._key(request_envelope), None)
+
+def rss_kb():
+    """ 今の常駐メモリ (KB) """
+    try:
+        with open('/proc/self/statm', 'rt') as file_pointer:
+            return int(file_pointer.read().split()[1]) * resource.getpagesize() // 1024
+    except (OSError, IndexError, ValueError):
+        return 0
+
+def request_name(event):
+    """ インテント名かリクエストの種類 """
+    request = event['request']
+    return request.get('intent', {}).get('name', request['type'])
+
+def play_music_event(template, rand, names, noise):
+    """ データベースの名前にノイズを入れた PlayMusicIntent を作る """
+    event = copy.deepcopy(template)
+    event['request']['requestId'] = 'amzn1.echo-api.request.replay-{}'.format(rand.randrange(1 << 30))
+    slots = event['request']['intent']['slots']
+    pattern = rand.choice([['Artist'], ['Album'], ['Title'], ['Artist', 'Title']])
+    for slot_name in ['Artist', 'Album', 'Title']:
+        slot = {'name': slot_name, 'confirmationStatus': 'NONE'}
+        if slot_name in pattern and names[slot_name]:
+            # 言語モデルに無い言い方をされた時と同じ ER_SUCCESS_NO_MATCH にする
+            slot['value'] = add_noise(rand.choice(names[slot_name]), rand, noise)
+            slot['resolutions'] = {'resolutionsPerAuthority': [
+                {'authority': 'replay.{}List'.format(slot_name), 'status': {'code': 'ER_SUCCESS_NO_MATCH'}}]}
+            slot['source'] = 'USER'
+        slots[slot_name] = slot
+    return event
+
+def audio_player_event(template, request_type, token, activity='PLAYING'):
+    """ 再生中の AudioPlayer イベントを作る """
+    event = {
+        'version': template['version'],
+        'context': copy.deepcopy(template['context']),
+        'request': {
+            'type': request_type,
+            'requestId': 'amzn1.echo-api.request.replay',
+            'timestamp': template['request']['timestamp'],
+            'locale': template['request']['locale'],
+            'token': token,
+            'offsetInMilliseconds': 0,
+        },
+    }
+    event['context']['AudioPlayer'] = {'playerActivity': activity, 'token': token, 'offsetInMilliseconds': 0}
+    return event
+
+def stream_token(response):
+    """ レスポンスの Play ディレクティブのトークン """
+    for directive in (response.get('response', {}) or {}).get('directives', None) or []:
+        if directive.get('type', '') == 'AudioPlayer.Play':
+            return directive['audioItem']['stream']['token']
+    return None
+
+def main():
+    """ main """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-e", "--events", help="event json files", type=str,
+                        default=os.path.join(BENCHMARK_DIR, '..', 'testevents', '*.json'))
+    parser.add_argument("-n", "--synthetic", help="number of synthetic PlayMusicIntent sessions", type=int, default=200)
+    parser.add_argument("--tracks", help="tracks played in each synthetic session", type=int, default=3)
+    parser.add_argument("--noise", help="noise rate per character", type=float, default=0.1)
+    parser.add_argument("--seed", help="random seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # import 前に決める必要がある設定
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.environ['METRICS'] = '1'
+
+    rss_start = rss_kb()
+    start = time.perf_counter()
+    import lambda_function # pylint: disable=import-outside-toplevel
+    import metrics # pylint: disable=import-outside-toplevel
+    import_ms = (time.perf_counter() - start) * 1000
+    rss_import = rss_kb()
+
+    adapter = MemoryPersistenceAdapter()
+    lambda_function.sb.persistence_adapter = adapter
+    handler = lambda_function.sb.lambda_handler()
+    stage_values = []
+    metrics.SINKS.append(stage_values.append)
+
+    latencies = {}
+    def invoke(event):
+        """ 1イベントを流して、応答時間を記録する """
+        begin = time.perf_counter()
+        response = handler(event, None)
+        latencies.setdefault(request_name(event), []).append((time.perf_counter() - begin) * 1000)
+        return response
+
+    # testevents
+    event_files = sorted(glob.glob(args.events))
+    first_ms = None
+    for event_file in event_files:
+        with open(event_file, 'rt', encoding='utf-8') as file_pointer:
+            event = json.load(file_pointer)
+        begin = time.perf_counter()
+        invoke(event)
+        if first_ms is None:
+            first_ms = (time.perf_counter() - begin) * 1000
+
+    # データベースの名前から作るイベント
+    rand = random.Random(args.seed)
+    with open(TEMPLATE_EVENT, 'rt', encoding='utf-8') as file_pointer:
+        template = json.load(file_pointer)
+    data_base = lambda_function.MUSIC_DB.data_base
+    names = {'Artist': list(data_base['artist'].keys()),
+             'Album': list(data_base['album'].keys()),
+             'Title': list(data_base['title'].keys())}
+    for _ in range(args.synthetic):
+        token = stream_token(invoke(play_music_event(template, rand, names, args.noise)))
+        for _ in range(args.tracks):
+            if not token:
+                break
+            invoke(audio_player_event(template, 'AudioPlayer.PlaybackStarted', token))
+            token = stream_token(invoke(audio_player_event(template, 'AudioPlayer.PlaybackNearlyFinished', token)))
+            invoke(audio_player_event(template, 'AudioPlayer.PlaybackFinished', token, 'FINISHED'))
+
+    print('metric\tvalue')
+    print('import_ms\t{:.3f}'.format(import_ms))
+    print('first_request_ms\t{:.3f}'.format(first_ms or 0.0))
+    print('rss_start_kb\t{}'.format(rss_start))
+    print('rss_import_kb\t{}'.format(rss_import))
+    print('rss_end_kb\t{}'.format(rss_kb()))
+    print('maxrss_kb\t{}'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+    for call, count in sorted(adapter.calls.items()):
+        print('persistence_{}\t{}'.format(call, count))
+    print()
+
+    print('handler\tcount\tp50_ms\tp95_ms\tp99_ms')
+    for name, values in sorted(latencies.items()):
+        print('{}\t{}\t{:.3f}\t{:.3f}\t{:.3f}'.format(
+            name, len(values), percentile(values, 0.5), percentile(values, 0.95), percentile(values, 0.99)))
+    print()
+
+    stages = {}
+    for values in stage_values:
+        for key, value in values.items():
+            if key.endswith('_ms'):
+                stages.setdefault(key[:-3], []).append(value)
+    print('stage\tcount\tp50_ms\tp95_ms\tp99_ms')
+    for name, values in sorted(stages.items()):
+        print('{}\t{}\t{:.3f}\t{:.3f}\t{:.3f}'.format(
+            name, len(values), percentile(values, 0.5), percentile(values, 0.95), percentile(values, 0.99)))
+    return True
+
+if __name__ == '__main__':
+    main()
@@ -7,17 +7,15 @@
 
 import boto3
 import os
-import random
 import re
 import sys
 import logging
-import itertools
 import json
 import traceback
 from urllib.parse import urljoin
 
-from ask_sdk_core.skill_builder import SkillBuilder
-from ask_sdk.standard import StandardSkillBuilder
+from ask_sdk_core.skill_builder import SkillBuilder, CustomSkillBuilder
+from ask_sdk_core.api_client import DefaultApiClient
 from ask_sdk_core.dispatch_components import (
     AbstractRequestHandler, AbstractExceptionHandler,
     AbstractRequestInterceptor, AbstractResponseInterceptor)
@@ -34,7 +32,10 @@ from ask_sdk_model.interfaces.audioplayer.audio_item_metadata import AudioItemMe
 from ask_sdk_model.interfaces.audioplayer.stream import Stream
 
 import util
+import metrics
 import musicsearch
+import persistence
+import playqueue
 
 SKILL_NAME = 'おうちサーバー'
 HELP_MESSAGE = 'おうちサーバーの楽曲を再生することができます。'
@@ -56,8 +57,17 @@ MUSICSEARCH = musicsearch.MusicSearch()
 MUSIC_DB = MUSICSEARCH.get_db()
 LOGGER.info("MusicSearch instance: end")
 MUSIC_URL_BASE = os.environ.get('MUSIC_URL_BASE', '')
+# title_id -> ストリームの url と AudioItemMetadata
+STREAM_CACHE = util.LruCache(int(os.environ.get('STREAM_CACHE_SIZE', '1024')))
+# PlaybackNearlyFinished で先読みする曲数
+LOOKAHEAD = int(os.environ.get('LOOKAHEAD', '5'))
+# (queue_key, 位置) -> ストリーム情報
+PREFETCH = util.LruCache(int(os.environ.get('PREFETCH_CACHE_SIZE', '256')))
 
-sb = StandardSkillBuilder(table_name="alexa-music-play")
+# StandardSkillBuilder の DynamoDbAdapter を、コンテナ内キャッシュ付きのものに替える
+sb = CustomSkillBuilder(
+    persistence_adapter=persistence.CachedDynamoDbAdapter(table_name="alexa-music-play"),
+    api_client=DefaultApiClient())
 
 
 def get_value_and_id(slots, attr_name):
@@ -88,32 +98,80 @@ def build_ssml_from_item_name(item_name):
     ssml = re.sub(r"([0-9A-Za-z][0-9A-Za-z\s.\-'!\?]*)", r'<lang xml:lang="en-US">\1</lang>', item_name)
     return ssml
 
+def get_queue_store(handler_input):
+    """ 永続属性の PlayQueueStore を得る。リクエストの間は同じものを返す """
+    request_attributes = handler_input.attributes_manager.request_attributes
+    store = request_attributes.get('queue_store', None)
+    if store is None:
+        with metrics.stage('persist_load'):
+            store = playqueue.PlayQueueStore(handler_input.attributes_manager, MUSICSEARCH,
+                                             sb.persistence_adapter, handler_input.request_envelope)
+        request_attributes['queue_store'] = store
+    return store
+
 def get_play_queue(handler_input):
-    try:
-        persistent_attributes = handler_input.attributes_manager.persistent_attributes
-        play_queue = persistent_attributes['play_queue']
-    except NameError:
-        return
-    play_queue['index'] = int(play_queue['index'])
-    return play_queue
+    """ 永続属性の再生キューを PlayQueue で得る """
+    return get_queue_store(handler_input).get_play_queue()
+
+def save_play_queue(handler_input):
+    """ 変わった所だけを永続化する """
+    with metrics.stage('persist_save'):
+        get_queue_store(handler_input).save()
+
+def stream_cache_version():
+    """ ストリーム情報が変わるのは、データベースか MUSIC_URL_BASE が変わった時 """
+    return (MUSIC_DB.get_version(), os.environ.get('MUSIC_URL_BASE', MUSIC_URL_BASE))
+
+def get_stream_info(title_id):
+    """ 曲IDからストリームの url と AudioItemMetadata を得る """
+    STREAM_CACHE.validate(stream_cache_version())
+    stream_info = STREAM_CACHE.get(title_id)
+    if stream_info is None:
+        url_base = STREAM_CACHE.version[1]
+        title_info = MUSIC_DB.get_title_by_id(title_id)
+        url = title_info.get('url', None)
+        if url is None or MUSIC_DB.get_url_base() != url_base:
+            url = urljoin(url_base, title_info['path'])
+        stream_info = {
+            'url': url,
+            'metadata': AudioItemMetadata(title=title_info['title'], subtitle=title_info['artist']),
+        }
+        STREAM_CACHE.put(title_id, stream_info)
+    return stream_info
+
+def prefetch_queue(play_queue, count=1):
+    """ 再生位置から count 曲分のストリーム情報をまとめて用意する
+
+    用意したものはコンテナに残しておき、続くイベントではそのまま使う
+    """
+    PREFETCH.validate(stream_cache_version())
+    queue_key = play_queue.queue_key()
+    entries = []
+    for index, title_id in play_queue.upcoming(count):
+        entry = PREFETCH.get((queue_key, index))
+        if entry is None:
+            entry = dict(get_stream_info(title_id), token=playqueue.make_token(index, title_id))
+            PREFETCH.put((queue_key, index), entry)
+        entries.append(entry)
+    return entries
 
 def play_from_queue(handler_input, play_behavior=PlayBehavior.REPLACE_ALL, offset_in_milliseconds=0, expected_previous_token=None):
     play_queue = get_play_queue(handler_input)
-    title_id = play_queue['list'][play_queue['index']]
-    title_info = MUSIC_DB.get_title_by_id(title_id)
-    meta_data = AudioItemMetadata(title=title_info['title'], subtitle=title_info['artist'])
+    with metrics.stage('stream'):
+        entry = prefetch_queue(play_queue)[0]
+    meta_data = entry['metadata']
     response_builder = handler_input.response_builder
     if play_behavior == PlayBehavior.ENQUEUE:
         stream = Stream(
-            token=title_id,
-            url=urljoin(MUSIC_URL_BASE, title_info['path']),
+            token=entry['token'],
+            url=entry['url'],
             offset_in_milliseconds=offset_in_milliseconds,
             expected_previous_token=expected_previous_token
         )
     else:
         stream = Stream(
-            token=title_id,
-            url=urljoin(MUSIC_URL_BASE, title_info['path']),
+            token=entry['token'],
+            url=entry['url'],
             offset_in_milliseconds=offset_in_milliseconds
         )
         play_queue['state'] = 'PLAY_REQUEST'
@@ -165,30 +223,23 @@ class PlayMusicHandler(AbstractRequestHandler):
             slots_title = get_value_and_id(slots, 'Title')
 
             # 最優秀候補を選ぶ
-            play_list = None
-            max_reliability = -1
-            for slots in [slots_artist, slots_album, slots_title]:
-                if len(slots) == 0:
-                    slots.append({'id': None, 'name': None})
-            for slot_artist, slot_album, slot_title in itertools.product(slots_artist, slots_album, slots_title):
-                candidate = MUSICSEARCH.get_play_list(artist_id=slot_artist.get('id', None), artist_name=slot_artist.get('name', None),
-                                                    album_id=slot_album.get('id', None), album_name=slot_album.get('name', None),
-                                                    title_id=slot_title.get('id', None), title_name=slot_title.get('name', None))
-                if candidate and candidate['reliability'] > max_reliability:
-                    play_list = candidate
-                    max_reliability = candidate['reliability']
-                    if max_reliability == 10:
-                        break
-
-            LOGGER.debug("play_list: %s", str(play_list))
-            persistent_attributes = handler_input.attributes_manager.persistent_attributes
+            with metrics.stage('search'):
+                play_list = MUSICSEARCH.get_play_list_batch(slots_artist, slots_album, slots_title)
+            metrics.record('play_list_type', play_list['type'] if play_list else None)
+
+            LOGGER.debug("play_list: %s", util.LogPayload(play_list))
+            store = get_queue_store(handler_input)
             if not play_list:
                 speech = 'ごめんなさい。わかりません。'
                 response_builder.speak(speech)
             else:
-                MUSICSEARCH.expansion_list(play_list)
+                # カラオケはスロットで明示された時だけ含める
+                include_karaoke = any(util.is_karaoke(slot.get('name', None))
+                                      for slot in slots_artist + slots_album + slots_title)
+                with metrics.stage('expand'):
+                    MUSICSEARCH.expansion_list(play_list, include_karaoke=include_karaoke)
                 if play_list['list']:
-                    play_queue = {'info': play_list, 'list': play_list['list'], 'index': 0, 'state': 'PLAY_REQUEST', 'playback_failure_count': 0}
+                    play_queue = playqueue.create_attributes(play_list)
                 if play_list['type'] == 'artist':
                     if play_list['list']:
                         speech = '{} の楽曲をシャッフル再生します。'.format(build_ssml_from_item_name(play_list['artist']['name']['value']))
@@ -211,10 +262,10 @@ class PlayMusicHandler(AbstractRequestHandler):
                     speech = 'ごめんなさい。わかりません。'
                     response_builder.speak(speech)
             if 'play_queue' in locals() and play_queue:
-                LOGGER.debug("play_queue: {}".format(str(play_queue)))
-                persistent_attributes['play_queue'] = play_queue
+                LOGGER.debug("play_queue: %s", util.LogPayload(play_queue))
+                store.set_play_queue(play_queue)
                 play_from_queue(handler_input)
-                handler_input.attributes_manager.save_persistent_attributes()
+                save_play_queue(handler_input)
         except:
             LOGGER.error("Unexpected error: {}".format(traceback.format_exc()))
         return handler_input.response_builder.response
@@ -231,7 +282,7 @@ class QueryTitleIntentHandler(AbstractRequestHandler):
         response_builder = handler_input.response_builder
         try:
             play_queue = get_play_queue(handler_input)
-            title_id = play_queue.get('now_playing', None)
+            _, title_id = playqueue.parse_token(play_queue.get('now_playing', None))
             if title_id and play_queue['state'] == 'PLAYING':
                 title_info = MUSIC_DB.get_title_by_id(title_id)
                 album_info = MUSIC_DB.get_album_by_id(title_info['album_id'])
@@ -280,9 +331,8 @@ class CancelOrStopIntentHandler(AbstractRequestHandler):
         handler_input.response_builder.add_directive(StopDirective())
         handler_input.response_builder.speak(STOP_MESSAGE)
         try:
-            persistent_attributes = handler_input.attributes_manager.persistent_attributes
-            persistent_attributes['play_queue'] = {}
-            handler_input.attributes_manager.save_persistent_attributes()
+            get_queue_store(handler_input).set_play_queue({})
+            save_play_queue(handler_input)
         except:
             LOGGER.error("Unexpected error: {}".format(traceback.format_exc()))
         return handler_input.response_builder.response
@@ -334,7 +384,8 @@ class PlaybackStartedHandler(AbstractRequestHandler):
             play_queue = get_play_queue(handler_input)
             play_queue['state'] = 'PLAYING'
             play_queue['now_playing'] = handler_input.request_envelope.request.token
-            handler_input.attributes_manager.save_persistent_attributes()
+            play_queue['playback_failure_count'] = 0
+            save_play_queue(handler_input)
         except:
             LOGGER.error("Unexpected error: {}".format(traceback.format_exc()))
         return handler_input.response_builder.response
@@ -349,7 +400,7 @@ class PlaybackFinishedHandler(AbstractRequestHandler):
         try:
             play_queue = get_play_queue(handler_input)
             play_queue['state'] = 'STOPPED'
-            handler_input.attributes_manager.save_persistent_attributes()
+            save_play_queue(handler_input)
         except:
             LOGGER.error("Unexpected error: {}".format(traceback.format_exc()))
         return handler_input.response_builder.response
@@ -380,7 +431,7 @@ class PauseIntentHandler(AbstractRequestHandler):
             play_queue = get_play_queue(handler_input)
             play_queue['offset_in_milliseconds'] = audio_player_state.offset_in_milliseconds
             play_queue['state'] = 'PAUSED'
-            handler_input.attributes_manager.save_persistent_attributes()
+            save_play_queue(handler_input)
         except:
             LOGGER.error("Unexpected error: {}".format(traceback.format_exc()))
         response_builder.add_directive(StopDirective())
@@ -403,7 +454,7 @@ class ResumeIntentHandler(AbstractRequestHandler):
             play_queue = get_play_queue(handler_input)
             if play_queue['state'] and play_queue['state'] == 'PAUSED':
                 play_from_queue(handler_input, offset_in_milliseconds=play_queue['offset_in_milliseconds'])
-                handler_input.attributes_manager.save_persistent_attributes()
+                save_play_queue(handler_input)
         except:
             LOGGER.error("Unexpected error: {}".format(traceback.format_exc()))
         return handler_input.response_builder.response
@@ -443,15 +494,12 @@ class NextIntentHandler(AbstractRequestHandler):
             play_queue = get_play_queue(handler_input)
             now_playing = play_queue.get('now_playing', None)
             if now_playing:
-                try:
-                    index = play_queue['list'].index(now_playing)
-                except ValueError:
-                    index = None
-                if index:
+                index = play_queue.position_of(now_playing)
+                if index is not None:
                     play_queue['index'] = index + 1
-                    play_queue['index'] %= len(play_queue['list'])
+                    play_queue['index'] %= len(play_queue.title_list)
                     play_from_queue(handler_input)
-            handler_input.attributes_manager.save_persistent_attributes()
+            save_play_queue(handler_input)
         except:
             LOGGER.error("Unexpected error: {}".format(traceback.format_exc()))
         return handler_input.response_builder.response
@@ -473,15 +521,12 @@ class PreviousIntentHandler(AbstractRequestHandler):
             play_queue = get_play_queue(handler_input)
             now_playing = play_queue.get('now_playing', None)
             if now_playing:
-                try:
-                    index = play_queue['list'].index(now_playing)
-                except ValueError:
-                    index = None
-                if index:
-                    play_queue['index'] = index + len(play_queue['list']) - 1
-                    play_queue['index'] %= len(play_queue['list'])
+                index = play_queue.position_of(now_playing)
+                if index is not None:
+                    play_queue['index'] = index + len(play_queue.title_list) - 1
+                    play_queue['index'] %= len(play_queue.title_list)
                     play_from_queue(handler_input)
-            handler_input.attributes_manager.save_persistent_attributes()
+            save_play_queue(handler_input)
         except:
             LOGGER.error("Unexpected error: {}".format(traceback.format_exc()))
         return handler_input.response_builder.response
@@ -505,11 +550,9 @@ class ShuffleOffIntentHandler(AbstractRequestHandler):
         try:
             play_queue = get_play_queue(handler_input)
             if play_queue.get('is_shuffle', False):
-                play_queue['list'] = list(play_queue['info']['list'])
-                play_queue['is_shuffle'] = False
-                play_queue['index'] = 0
+                play_queue.set_shuffle(False)
                 play_from_queue(handler_input)
-                handler_input.attributes_manager.save_persistent_attributes()
+                save_play_queue(handler_input)
         except:
             LOGGER.error("Unexpected error: {}".format(traceback.format_exc()))
         return handler_input.response_builder.response
@@ -523,13 +566,10 @@ class ShuffleOnIntentHandler(AbstractRequestHandler):
         LOGGER.debug("In ShuffleOnIntent")
         try:
             play_queue = get_play_queue(handler_input)
-            if play_queue['info']['can_shuffle'] and not play_queue.get('is_shuffle', False):
-                play_queue['list'] = list(play_queue['info']['list'])
-                random.shuffle(play_queue['list'])
-                play_queue['is_shuffle'] = True
-                play_queue['index'] = 0
+            if play_queue.get('can_shuffle', False) and not play_queue.get('is_shuffle', False):
+                play_queue.set_shuffle(True)
                 play_from_queue(handler_input)
-                handler_input.attributes_manager.save_persistent_attributes()
+                save_play_queue(handler_input)
         except:
             LOGGER.error("Unexpected error: {}".format(traceback.format_exc()))
         return handler_input.response_builder.response
@@ -545,9 +585,8 @@ class StartOverIntentHandler(AbstractRequestHandler):
         handler_input.response_builder.add_directive(ClearQueueDirective())
         handler_input.response_builder.add_directive(StopDirective())
         handler_input.response_builder.speak(STOP_MESSAGE)
-        persistent_attributes = handler_input.attributes_manager.persistent_attributes
-        persistent_attributes['play_queue'] = {}
-        handler_input.attributes_manager.save_persistent_attributes()
+        get_queue_store(handler_input).set_play_queue({})
+        save_play_queue(handler_input)
         return handler_input.response_builder.response
 
 class PlaybackFailedHandler(AbstractRequestHandler):
@@ -561,18 +600,21 @@ class PlaybackFailedHandler(AbstractRequestHandler):
         response_builder = handler_input.response_builder
         try:
             play_queue = get_play_queue(handler_input)
-            if play_queue and play_queue['playback_failure_count']:
-                play_queue['playback_failure_count'] += 1
+            play_queue['playback_failure_count'] = play_queue.get('playback_failure_count', 0) + 1
             if play_queue['playback_failure_count'] > 5:
                 handler_input.response_builder.add_directive(ClearQueueDirective())
                 handler_input.response_builder.add_directive(StopDirective())
                 handler_input.response_builder.speak('再生できませんでした')
-            elif play_queue:
+            else:
+                # 失敗した曲の次から
+                index = play_queue.position_of(handler_input.request_envelope.request.token)
+                if index is not None:
+                    play_queue['index'] = index
                 play_queue['index'] += 1
-                play_queue['index'] %= len(play_queue['list'])
+                play_queue['index'] %= len(play_queue.title_list)
                 play_from_queue(handler_input)
                 play_queue['state'] = 'PLAY_REQUEST'
-            handler_input.attributes_manager.save_persistent_attributes()
+            save_play_queue(handler_input)
         except:
             LOGGER.error("Unexpected error: {}".format(traceback.format_exc()))
         return handler_input.response_builder.response
@@ -589,11 +631,18 @@ class PlaybackNearlyFinishedHandler(AbstractRequestHandler):
         response_builder = handler_input.response_builder
         try:
             play_queue = get_play_queue(handler_input)
-            expected_previous_token = play_queue['index']
+            expected_previous_token = handler_input.request_envelope.request.token
+            # 再生中の曲の次を積む
+            index = play_queue.position_of(expected_previous_token)
+            if index is not None:
+                play_queue['index'] = index
             play_queue['index'] += 1
-            play_queue['index'] %= len(play_queue['list'])
+            play_queue['index'] %= len(play_queue.title_list)
+            # 次の数曲分をまとめて用意しておく (AudioPlayer に積めるのは1曲ずつ)
+            with metrics.stage('prefetch'):
+                prefetch_queue(play_queue, LOOKAHEAD)
             play_from_queue(handler_input, play_behavior=PlayBehavior.ENQUEUE, expected_previous_token=expected_previous_token)
-            handler_input.attributes_manager.save_persistent_attributes()
+            save_play_queue(handler_input)
         except:
             LOGGER.error("Unexpected error: {}".format(traceback.format_exc()))
         return handler_input.response_builder.response
@@ -612,6 +661,9 @@ class CatchAllExceptionHandler(AbstractExceptionHandler):
         # type: (HandlerInput, Exception) -> Response
         LOGGER.info("In CatchAllExceptionHandler")
         LOGGER.error(exception, exc_info=True)
+        # ハンドラが例外を投げると応答のインターセプタは呼ばれないので、ここで計測を終える
+        metrics.record('exception', type(exception).__name__)
+        metrics.end()
 
         handler_input.response_builder.speak(EXCEPTION_MESSAGE).ask(
             HELP_REPROMPT)
@@ -624,14 +676,36 @@ class RequestLogger(AbstractRequestInterceptor):
     """ Log the alexa requests. """
     def process(self, handler_input):
         # type: (HandlerInput) -> None
-        LOGGER.debug("Alexa Request: %s", str(handler_input.request_envelope.request))
+        # リクエストとレスポンスは同じリクエストで揃えて間引く
+        sampled = LOGGER.isEnabledFor(logging.DEBUG) and util.log_sampled()
+        handler_input.attributes_manager.request_attributes['log_sampled'] = sampled
+        if sampled:
+            LOGGER.debug("Alexa Request: %s", util.LogPayload(handler_input.request_envelope.request))
 
 
 class ResponseLogger(AbstractResponseInterceptor):
     """ Log the alexa responses. """
     def process(self, handler_input, response):
         # type: (HandlerInput, Response) -> None
-        LOGGER.debug("Alexa Response: %s", str(response))
+        if handler_input.attributes_manager.request_attributes.get('log_sampled', False):
+            LOGGER.debug("Alexa Response: %s", util.LogPayload(response))
+
+
+class MetricsRequestInterceptor(AbstractRequestInterceptor):
+    """ リクエストの計測を始める """
+    def process(self, handler_input):
+        # type: (HandlerInput) -> None
+        if metrics.ENABLED:
+            request = handler_input.request_envelope.request
+            intent = getattr(request, 'intent', None)
+            metrics.begin(intent.name if intent else request.object_type)
+
+
+class MetricsResponseInterceptor(AbstractResponseInterceptor):
+    """ リクエストの計測をログに出す """
+    def process(self, handler_input, response):
+        # type: (HandlerInput, Response) -> None
+        metrics.end()
 
 
 # Register intent handlers
@@ -664,6 +738,8 @@ sb.add_exception_handler(CatchAllExceptionHandler())
 # TODO: Uncomment the following lines of code for request, response logs.
 sb.add_global_request_interceptor(RequestLogger())
 sb.add_global_response_interceptor(ResponseLogger())
+sb.add_global_request_interceptor(MetricsRequestInterceptor())
+sb.add_global_response_interceptor(MetricsResponseInterceptor())
 
 # Handler name that is used on AWS lambda
 lambda_handler = sb.lambda_handler()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+"""
+リクエストごとの処理時間・回数の計測
+
+METRICS=1 の時だけ計測して、リクエストの終わりに1行の JSON でログに出す。
+CloudWatch Logs のメトリクスフィルタで { $.metrics = "request" && $.total_ms > 1000 }
+の様に拾える様に、キーは平らに "<段階>_ms", "<名前>" とする。
+無効な時は何もしない文脈マネージャを返すだけにする。
+"""
+
+import json
+import os
+import time
+
+import util
+
+LOGGER = util.get_logger(__name__)
+
+ENABLED = os.environ.get('METRICS', '').lower() in ['1', 'true', 'on', 'yes']
+# ログの他に計測値を受け取る関数 (ベンチマーク用)
+SINKS = []
+
+class _NullTimer:
+    """ 計測しない時の文脈マネージャ """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_TIMER = _NullTimer()
+
+class _Timer:
+    """ with の間の時間を段階の時間に足す """
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.recorder.add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+class Recorder:
+    """ 1リクエスト分の計測値 """
+    def __init__(self, request_name):
+        self.start = time.perf_counter()
+        self.values = {'metrics': 'request', 'request': request_name}
+
+    def add_time(self, name, seconds):
+        """ 段階の時間を足す """
+        key = name + '_ms'
+        self.values[key] = self.values.get(key, 0.0) + seconds * 1000
+
+    def count(self, name, increment=1):
+        """ 回数を数える """
+        self.values[name] = self.values.get(name, 0) + increment
+
+    def set(self, name, value):
+        """ 値を記録する """
+        self.values[name] = value
+
+    def to_json(self):
+        """ 1行の JSON にする """
+        values = dict(self.values)
+        for key, value in values.items():
+            if isinstance(value, float):
+                values[key] = round(value, 3)
+        return json.dumps(values, ensure_ascii=False, separators=(',', ':'), sort_keys=True)
+
+_CURRENT = None
+
+def begin(request_name):
+    """ リクエストの計測を始める """
+    global _CURRENT # pylint: disable=global-statement
+    _CURRENT = Recorder(request_name) if ENABLED else None
+
+def end():
+    """ 計測を終えてログに出す """
+    global _CURRENT # pylint: disable=global-statement
+    recorder = _CURRENT
+    _CURRENT = None
+    if recorder is not None:
+        recorder.set('total_ms', (time.perf_counter() - recorder.start) * 1000)
+        LOGGER.info("%s", recorder.to_json())
+        for sink in SINKS:
+            sink(recorder.values)
+
+def stage(name):
+    """ with metrics.stage('name'): で囲んだ間の時間を計る """
+    if _CURRENT is None:
+        return NULL_TIMER
+    return _Timer(_CURRENT, name)
+
+def count(name, increment=1):
+    """ 回数を数える """
+    if _CURRENT is not None:
+        _CURRENT.count(name, increment)
+
+def record(name, value):
+    """ 値を記録する """
+    if _CURRENT is not None:
+        _CURRENT.set(name, value)
@@ -8,28 +8,148 @@
 import json
 import os
 import pickle
-from simstring.measure.jaccard import JaccardMeasure
-from simstring.searcher import Searcher
+import metrics
+import ngram
+import snapshot
 import util
 
 LOGGER = util.get_logger(__name__)
 
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+SNAPSHOT_PATH = os.path.join(DATA_DIR, 'database.snap')
+JSON_PATH = os.path.join(DATA_DIR, 'database.json')
+NGRAM_PATH = os.path.join(DATA_DIR, 'ngram.db')
+NAME_CACHE_SIZE = int(os.environ.get('NAME_CACHE_SIZE', '1024'))
+# アーティストごとの曲名の n-gram 索引を、いくつのアーティスト分まで持っておくか
+ARTIST_TITLE_INDEX_SIZE = int(os.environ.get('ARTIST_TITLE_INDEX_SIZE', '64'))
+# シャードに分けたスナップショットで、同時に開いておくシャードの大きさの上限 (MB)
+SHARD_BUDGET_MB = int(os.environ.get('MUSICDB_SHARD_BUDGET_MB', '64'))
+# 無くても良いテーブル
+OPTIONAL_TABLES = ['artist_title', 'meta']
+
 class MusicDb:
-    """ database.json の実体化 """
+    """ database.json の実体化
+
+    起動時には何も読まず、id テーブル・名前辞書・検索器をそれぞれ初めて
+    参照された時に読み込む
+    """
     def __init__(self):
         """ initialize """
-        dirname = os.path.dirname(__file__)
-        path = os.path.join(dirname, 'data', 'database.json')
-        with open(path, 'rt', encoding='utf-8') as file_pointer:
-            self.data_base = json.load(file_pointer)
-        path = os.path.join(dirname, 'data', 'simstring.db')
-        with open(path, 'rb') as db_file_pointer:
-            self.simstring_db = pickle.load(db_file_pointer)
-        self.sercher = {}
-        for item in ['artist', 'album', 'title']:
-            self.sercher[item] = Searcher(self.simstring_db[item], JaccardMeasure())
+        # 名前解決の結果はコンテナが生きている間キャッシュする
+        self.entry_cache = util.LruCache(NAME_CACHE_SIZE)
+        self.entry_list_cache = util.LruCache(NAME_CACHE_SIZE)
+        self.artist_title_index = util.LruCache(ARTIST_TITLE_INDEX_SIZE)
+        self.reload()
         return
 
+    def reload(self):
+        """ 読み込み済みのデータを捨てる。名前解決のキャッシュはバージョンが変わった時に捨てる """
+        # MUSICDB_FORMAT=json で従来の database.json を強制する
+        self.use_snapshot = (os.environ.get('MUSICDB_FORMAT', '') != 'json'
+                             and os.path.exists(SNAPSHOT_PATH))
+        self.snapshot = None
+        self.shard_set = None
+        self.json_db = None
+        self.json_version = None
+        self.ngram_db = None
+        self.data_base = util.LazyDict(self._load_table)
+        self.sercher = util.LazyDict(self._load_searcher)
+        self.substring_index = util.LazyDict(self._load_substring_index)
+
+    def _load_substring_index(self, item):
+        """ 部分一致索引を得る。database.json には無いので None """
+        if not self.use_snapshot:
+            return None
+        return self._open_snapshot().substring_index(item, self.data_base[item])
+
+    def _full_text_matches(self, entry_type, entry_name, norm_name):
+        """ 全文検索。名前辞書の順に (id, priority) を返す """
+        index = self.substring_index[entry_type]
+        if index is not None:
+            return index.matches(entry_name, norm_name)
+        matches = []
+        for key, value in self.data_base[entry_type].items():
+            if entry_name in key:
+                matches.append((value['id'], value['priority']))
+            if norm_name in key:
+                matches.append((value['id'], value['priority'] + 10))
+        return matches
+
+    def get_version(self):
+        """ 読み込んでいるデータのバージョン """
+        if self.use_snapshot:
+            return self._open_snapshot().version
+        self._load_json()
+        return self.json_version
+
+    def cache_stats(self):
+        """ 名前解決キャッシュとシャードの統計 """
+        stats = {'entry': self.entry_cache.stats(), 'entry_list': self.entry_list_cache.stats(),
+                 'artist_title_index': self.artist_title_index.stats()}
+        if self.shard_set is not None:
+            stats['shard'] = self.shard_set.stats()
+        return stats
+
+    def _open_snapshot(self):
+        """ スナップショットを開く。レコードは参照時にデコードされる """
+        if self.snapshot is None:
+            self.snapshot = snapshot.Snapshot(SNAPSHOT_PATH)
+            LOGGER.debug("MusicDb: snapshot version=%s", self.snapshot.version)
+            shards = self.snapshot.shards()
+            if shards:
+                # レコードはシャードのファイルにあり、予算の範囲で開く
+                self.shard_set = snapshot.ShardSet(SNAPSHOT_PATH, shards, SHARD_BUDGET_MB * 1024 * 1024)
+                LOGGER.debug("MusicDb: %d shards", len(shards))
+        return self.snapshot
+
+    def _shard_table(self, name):
+        """ シャードに分けたレコードテーブルを得る。どのシャードにも無ければ None """
+        if not any(name in shard['counts'] for shard in self.shard_set.shards):
+            return None
+        return snapshot.ShardedTable(self.shard_set, name)
+
+    def _load_json(self):
+        """ database.json を読む """
+        if self.json_db is None:
+            LOGGER.debug("MusicDb: load database.json")
+            with open(JSON_PATH, 'rt', encoding='utf-8') as file_pointer:
+                self.json_version = str(os.fstat(file_pointer.fileno()).st_mtime_ns)
+                self.json_db = json.load(file_pointer)
+        return self.json_db
+
+    def _load_table(self, key):
+        """ data_base[key] (名前辞書 または 'music', 'artist_title', 'meta') を読む """
+        if not self.use_snapshot:
+            # artist_title, meta は古い database.json には無い
+            return self._load_json().get(key, None) if key in OPTIONAL_TABLES else self._load_json()[key]
+        self._open_snapshot()
+        if self.shard_set is not None and key == 'music':
+            return util.LazyDict(lambda item_type: self._shard_table('music.' + item_type))
+        if self.shard_set is not None and key == 'artist_title':
+            return self._shard_table(key)
+        if key == 'music':
+            return util.LazyDict(self._open_snapshot().records)
+        if key in OPTIONAL_TABLES:
+            if not self._open_snapshot().has(key + '.key.off'):
+                return None
+            return self._open_snapshot().table(key)
+        return self._open_snapshot().names(key)
+
+    def _load_searcher(self, item):
+        """ item 種別ごとの n-gram 検索器を得る """
+        if self.use_snapshot:
+            return self._open_snapshot().searcher(item)
+        if self.ngram_db is None:
+            if os.path.exists(NGRAM_PATH):
+                LOGGER.debug("MusicDb: load ngram.db")
+                with open(NGRAM_PATH, 'rb') as db_file_pointer:
+                    self.ngram_db = pickle.load(db_file_pointer)
+            else:
+                self.ngram_db = {}
+        if item not in self.ngram_db:
+            self.ngram_db[item] = ngram.NgramIndex(self.data_base[item].keys())
+        return self.ngram_db[item]
+
     def get_db(self):
         """ dbアクセサ """
         return self.data_base
@@ -39,6 +159,11 @@ class MusicDb:
         item = self.data_base['music'][item_type].get(item_id, None)
         return item
 
+    def get_url_base(self):
+        """ ビルド時に title の url を解決した MUSIC_URL_BASE。解決していなければ None """
+        meta = self.data_base['meta']
+        return meta.get('url_base', None) if meta else None
+
     def get_title_by_id(self, title_id):
         """ Title ID から Titleの情報を得る """
         title = self.data_base['music']['title'].get(title_id, None)
@@ -60,26 +185,45 @@ class MusicDb:
 
     def get_entry_by_name(self, entry_type, entry_name, level=0):
         """ 名前からIDを得る """
+        key = (entry_type, entry_name, level)
+        self.entry_cache.validate(self.get_version())
+        entry_id = self.entry_cache.get(key, util.LruCache.MISSING)
+        if entry_id is util.LruCache.MISSING:
+            metrics.count('name_cache_miss')
+            entry_id = self._get_entry_by_name(entry_type, entry_name, level)
+            self.entry_cache.put(key, entry_id)
+        else:
+            metrics.count('name_cache_hit')
+        return entry_id
+
+    def _get_entry_by_name(self, entry_type, entry_name, level):
+        """ 名前からIDを得る (キャッシュなし) """
 
         # 完全マッチ
-        entry_dict = self.data_base[entry_type]
-        entry = entry_dict.get(entry_name, None)
+        with metrics.stage('search_exact'):
+            entry_dict = self.data_base[entry_type]
+            entry = entry_dict.get(entry_name, None)
         if entry:
+            metrics.count('search_hit_exact')
             return entry['id']
         if level > 3:
             return None
 
         # 読み正規化マッチ
-        norm_name = util.yomi_normalize(entry_name)
-        entry = entry_dict.get(norm_name, None)
+        with metrics.stage('search_yomi'):
+            norm_name = util.yomi_normalize(entry_name)
+            entry = entry_dict.get(norm_name, None)
         if entry:
+            metrics.count('search_hit_yomi')
             return entry['id']
         if level > 2:
             return None
 
-        # SimString検索
-        indexes = self.sercher[entry_type].ranked_search(entry_name, 0.3)
+        # n-gram 類似検索
+        with metrics.stage('search_ngram'):
+            indexes = self.sercher[entry_type].ranked_search(entry_name, 0.3)
         if indexes:
+            metrics.count('search_hit_ngram')
             return entry_dict[indexes[0][1]]['id']
         if level > 1:
             return None
@@ -87,21 +231,33 @@ class MusicDb:
         # 全文検索
         min_priority = 99
         entry_id = None
-        for key, value in entry_dict.items():
-            if entry_name in key:
-                if value['priority'] < min_priority:
-                    entry_id = value['id']
-                    min_priority = value['priority']
-            if norm_name in key:
-                if value['priority'] + 10 < min_priority:
-                    entry_id = value['id']
-                    min_priority = value['priority'] + 10
-            if min_priority == 0:
-                return entry_id
+        with metrics.stage('search_fulltext'):
+            for item_id, priority in self._full_text_matches(entry_type, entry_name, norm_name):
+                if priority < min_priority:
+                    entry_id = item_id
+                    min_priority = priority
+                    if min_priority == 0:
+                        break
+        metrics.count('search_hit_fulltext' if entry_id else 'search_miss')
         return entry_id
 
     def get_entry_list_by_name(self, entry_type, entry_name, level=0):
         """ 名前からIDのリストを得る """
+        key = (entry_type, entry_name, level)
+        self.entry_list_cache.validate(self.get_version())
+        entry_list = self.entry_list_cache.get(key, util.LruCache.MISSING)
+        if entry_list is util.LruCache.MISSING:
+            metrics.count('name_cache_miss')
+            with metrics.stage('search_list'):
+                entry_list = self._get_entry_list_by_name(entry_type, entry_name, level)
+            self.entry_list_cache.put(key, entry_list)
+        else:
+            metrics.count('name_cache_hit')
+        # 呼び出し側で書き換えられても良い様にコピーを返す
+        return list(entry_list) if entry_list is not None else None
+
+    def _get_entry_list_by_name(self, entry_type, entry_name, level):
+        """ 名前からIDのリストを得る (キャッシュなし) """
 
         entry_list = []
         # 完全マッチ
@@ -120,7 +276,7 @@ class MusicDb:
         if level > 2:
             return None
 
-        # SimString検索
+        # n-gram 類似検索
         indexes = self.sercher[entry_type].ranked_search(entry_name, 0.3)
         if indexes:
             entry_list.extend([entry_dict[index[1]]['id'] for index in indexes])
@@ -128,13 +284,8 @@ class MusicDb:
             return None
 
         # 全文検索
-        entry_id_list = []
-        for key, value in entry_dict.items():
-            if entry_name in key:
-                entry_id_list.append({'id': value['id'], 'priority': value['priority']})
-            if norm_name in key:
-                entry_id_list.append({'id': value['id'], 'priority': value['priority'] + 10})
-        entry_list.extend([entry['id'] for entry in sorted(entry_id_list, key=lambda entry: entry['priority'])])
+        entry_id_list = self._full_text_matches(entry_type, entry_name, norm_name)
+        entry_list.extend([entry[0] for entry in sorted(entry_id_list, key=lambda entry: entry[1])])
         return entry_list
 
     def get_artist_by_name(self, artist_name, level=0):
@@ -151,6 +302,11 @@ class MusicDb:
             artist_id = self.get_artist_by_name(artist_name)
             if not artist_id:
                 return None
+            artist_titles = self.data_base['artist_title']
+            if artist_titles is not None:
+                with metrics.stage('search_artist_title'):
+                    return self._get_artist_title_by_name(artist_id, artist_titles.get(artist_id, {}),
+                                                          title_name, level)
             artist = self.get_artist_by_id(artist_id)
             artist_title_list = artist['title']
             title_list = self.get_entry_list_by_name('title', title_name, level)
@@ -161,6 +317,47 @@ class MusicDb:
             return self.get_entry_by_name('title', title_name, level)
         return
 
+    def _get_artist_title_by_name(self, artist_id, title_keys, title_name, level):
+        """ アーティストの曲名辞書 (読み -> [[title_id, priority], ...]) だけから探す """
+        # 完全マッチ
+        entries = title_keys.get(title_name, None)
+        if entries:
+            return entries[0][0]
+        if level > 3:
+            return None
+
+        # 読み正規化マッチ
+        norm_name = util.yomi_normalize(title_name)
+        entries = title_keys.get(norm_name, None)
+        if entries:
+            return entries[0][0]
+        if level > 2:
+            return None
+
+        # n-gram 類似検索 (そのアーティストの曲名だけの索引を作って使い回す)
+        self.artist_title_index.validate(self.get_version())
+        searcher = self.artist_title_index.get(artist_id)
+        if searcher is None:
+            searcher = ngram.NgramIndex(title_keys)
+            self.artist_title_index.put(artist_id, searcher)
+        results = searcher.ranked_search(title_name, 0.3)
+        if results:
+            return title_keys[results[0][1]][0][0]
+        if level > 1:
+            return None
+
+        # 全文検索
+        min_priority = 99
+        title_id = None
+        for key, entries in title_keys.items():
+            if title_name in key and entries[0][1] < min_priority:
+                title_id = entries[0][0]
+                min_priority = entries[0][1]
+            if norm_name in key and entries[0][1] + 10 < min_priority:
+                title_id = entries[0][0]
+                min_priority = entries[0][1] + 10
+        return title_id
+
 def module_test():
     """ module test """
     music_db = MusicDb()
@@ -6,12 +6,29 @@
 """
 
 import argparse
+import itertools
 import random
 import musicdb
 import util
 
 LOGGER = util.get_logger(__name__)
 
+class MemoizedDb:
+    """ 1回の楽曲選択の間、同じ問い合わせを MusicDb に繰り返さない様に結果を覚える """
+    def __init__(self, music_db):
+        """ initialize """
+        self.music_db = music_db
+        self.memo = {}
+
+    def __getattr__(self, name):
+        method = getattr(self.music_db, name)
+        def memoized(*args, **kwargs):
+            key = (name, args, tuple(sorted(kwargs.items())))
+            if key not in self.memo:
+                self.memo[key] = method(*args, **kwargs)
+            return self.memo[key]
+        return memoized
+
 class MusicSearch:
     """ 楽曲セレクタ """
     def __init__(self):
@@ -23,31 +40,85 @@ class MusicSearch:
         """ 同じリソースを2回読まないで良い様に """
         return self.music_db
 
-    def expansion_list(self, searched_item):
+    def playable_title_list(self, item, include_karaoke=False):
+        """ アーティスト・アルバムの再生対象のタイトルIDリスト(コピー)を得る """
+        if include_karaoke:
+            return list(item['title'])
+        playable = item.get('playable', None)
+        if playable is None:
+            # playable の無い古い database
+            get_title_id = self.music_db.get_title_by_id
+            playable = [title_id for title_id in item['title'] if not get_title_id(title_id)['karaoke']]
+        return list(playable)
+
+    def build_title_list(self, item_type, item_id, seed=None, include_karaoke=False):
+        """ 再生する曲IDのリストを作る。seed があれば、その seed でシャッフルする """
+        if item_type == 'title':
+            return [item_id]
+        item = self.music_db.get_item_by_id(item_type, item_id)
+        if not item:
+            return []
+        title_list = self.playable_title_list(item, include_karaoke)
+        if item_type == 'album' and not title_list:
+            # カラオケしか無いアルバムはそのまま再生する
+            title_list = list(item['title'])
+        if seed is not None:
+            random.Random(seed).shuffle(title_list)
+        return title_list
+
+    def expansion_list(self, searched_item, include_karaoke=False):
         """ 検索結果からリストを拡張する """
+        searched_item['include_karaoke'] = include_karaoke
         if searched_item['type'] == 'artist':
-            get_title_id = self.music_db.get_title_by_id
-            artist = searched_item['artist']
-            title_list = list([title_id for title_id in artist['title'] if not get_title_id(title_id)['karaoke']])
-            random.shuffle(title_list)
-            searched_item['list'] = title_list
+            searched_item['seed'] = random.randrange(1 << 31)
             searched_item['shuffle'] = True
             searched_item['can_shuffle'] = False
         elif searched_item['type'] == 'album':
-            title_list = searched_item['album']['title']
-            searched_item['list'] = list(title_list)
-            searched_item['original_list'] = title_list
+            searched_item['seed'] = None
             searched_item['shuffle'] = False
             searched_item['can_shuffle'] = True
         else:
-            searched_item['list'] = [ searched_item['id'] ]
+            searched_item['seed'] = None
             searched_item['shuffle'] = False
             searched_item['can_shuffle'] = False
+        searched_item['list'] = self.build_title_list(searched_item['type'], searched_item['id'],
+                                                      seed=searched_item['seed'],
+                                                      include_karaoke=include_karaoke)
         return
 
+    def get_play_list_batch(self, slots_artist, slots_album, slots_title):
+        """ スロット候補の全組み合わせから、最も信頼性の高い楽曲選択を行う
+
+        各スロットは {'id': ..., 'name': ...} のリスト。名前や ID の解決は
+        組み合わせ間で共有するので、同じ値を2回検索しない
+        """
+        music_db = MemoizedDb(self.music_db)
+        play_list = None
+        for slot_artist, slot_album, slot_title in itertools.product(
+                slots_artist or [{}], slots_album or [{}], slots_title or [{}]):
+            candidate = self._get_play_list(music_db,
+                                            artist_id=slot_artist.get('id', None),
+                                            album_id=slot_album.get('id', None),
+                                            title_id=slot_title.get('id', None),
+                                            artist_name=slot_artist.get('name', None),
+                                            album_name=slot_album.get('name', None),
+                                            title_name=slot_title.get('name', None))
+            if candidate and (not play_list or candidate['reliability'] > play_list['reliability']):
+                play_list = candidate
+                if play_list['reliability'] == 10:
+                    break
+        return play_list
+
     def get_play_list(self, artist_id=None, album_id=None, title_id=None,
                       artist_name=None, album_name=None, title_name=None):
         """ 楽曲選択を行う """
+        return self._get_play_list(self.music_db, artist_id=artist_id, album_id=album_id,
+                                   title_id=title_id, artist_name=artist_name,
+                                   album_name=album_name, title_name=title_name)
+
+    def _get_play_list(self, music_db, artist_id=None, album_id=None, title_id=None,
+                       artist_name=None, album_name=None, title_name=None):
+        """ 楽曲選択を行う (music_db は MusicDb か MemoizedDb) """
 
         LOGGER.debug("get_play_list: artist_id=%s", artist_id)
         LOGGER.debug("get_play_list: album_id=%s", album_id)
@@ -58,57 +129,54 @@ class MusicSearch:
 
         # artist, title 指定を最優先
         if artist_name and title_name:
-            title_id = self.music_db.get_title_by_name(title_name, 1, artist_name=artist_name)
+            title_id = music_db.get_title_by_name(title_name, 1, artist_name=artist_name)
             if title_id:
-                title = self.music_db.get_title_by_id(title_id)
+                title = music_db.get_title_by_id(title_id)
                 LOGGER.debug('get_play_list: (artist_name and title_name) %s', title_id)
                 return {'type': 'title', 'id': title_id, 'title': title, 'reliability': 10}
 
         # IDが来て、マッチすれば信頼性Max
         if title_id:
-            title = self.music_db.get_title_by_id(title_id)
+            title = music_db.get_title_by_id(title_id)
             if title:
                 LOGGER.debug('get_play_list: (title_id) %s', title_id)
                 return {'type': 'title', 'id': title_id, 'title': title, 'reliability': 5}
         elif album_id:
-            album = self.music_db.get_album_by_id(album_id)
+            album = music_db.get_album_by_id(album_id)
             if album:
                 LOGGER.debug('get_play_list: (album_id) %s', album_id)
                 return {'type': 'album', 'id': album_id, 'album': album, 'reliability': 5}
         elif artist_id:
-            artist = self.music_db.get_artist_by_id(artist_id)
+            artist = music_db.get_artist_by_id(artist_id)
             if artist:
                 LOGGER.debug('get_play_list: (artist_id) %s', artist_id)
-                get_title_id = self.music_db.get_title_by_id
-                title_list = list([title_id for title_id in artist['title'] if not get_title_id(title_id)['karaoke']])
-                random.shuffle(title_list)
-                return {'type': 'artist', 'id': artist_id, 'artist': artist, 'list': title_list, 'reliability': 5}
+                return {'type': 'artist', 'id': artist_id, 'artist': artist, 'reliability': 5}
 
         # 一致検索が次点
         elif title_name:
-            title_id = self.music_db.get_title_by_name(title_name, 1)
+            title_id = music_db.get_title_by_name(title_name, 1)
             if title_id:
                 LOGGER.debug('get_play_list: (title_name) %s->%s', title_name, title_id)
-                title = self.music_db.get_title_by_id(title_id)
+                title = music_db.get_title_by_id(title_id)
                 return {'type': 'title', 'id': title_id, 'title': title, 'list': [title_id], 'reliability': 4}
         elif album_name:
-            album_id = self.music_db.get_album_by_name(album_name, 1)
+            album_id = music_db.get_album_by_name(album_name, 1)
             if album_id:
                 LOGGER.debug('get_play_list: (album_name) %s->%s', album_name, album_id)
-                album = self.music_db.get_album_by_id(album_id)
+                album = music_db.get_album_by_id(album_id)
                 return {'type': 'album', 'id': album_id, 'album': album, 'reliability': 4}
         elif artist_name:
-            artist_id = self.music_db.get_artist_by_name(artist_name, 1)
+            artist_id = music_db.get_artist_by_name(artist_name, 1)
             if artist_id:
                 LOGGER.debug('get_play_list: (artist_name) %s->%s', artist_name, artist_id)
-                artist = self.music_db.get_artist_by_id(artist_id)
+                artist = music_db.get_artist_by_id(artist_id)
                 return {'type': 'artist', 'id': artist_id, 'artist': artist, 'reliability': 4}
 
         # IDでヒットしたけれど、スロットが違う
         for i, item_id in enumerate([artist_id, album_id, title_id]):
             for j, item_type in enumerate(['artist', 'album', 'title']):
                 if item_id and i != j:
-                    item = self.music_db.get_item_by_id(item_type, item_id)
+                    item = music_db.get_item_by_id(item_type, item_id)
                     if item:
                         LOGGER.debug('get_play_list: (slot no match %s_id) %s', item_type, item_id)
                         return {'type': item_type, 'id': item_id, item_type: item, 'reliability': 3}
@@ -117,10 +185,10 @@ class MusicSearch:
         for i, name in enumerate([artist_name, album_name, title_name]):
             if name:
                 for j, item_type in enumerate(['artist', 'album', 'title']):
-                    item_id = self.music_db.get_entry_by_name(item_type, name)
+                    item_id = music_db.get_entry_by_name(item_type, name)
                     if item_id:
                         LOGGER.debug('get_play_list: (slot no match %s_name) %s', item_type, item_id)
-                        item = self.music_db.get_item_by_id(item_type, item_id)
+                        item = music_db.get_item_by_id(item_type, item_id)
                         return {'type': item_type, 'id': item_id, item_type: item,
                                 'reliability': 2 if i == j else 1}
         # 何も見つけられなかった
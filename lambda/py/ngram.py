@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+"""
+文字 n-gram によるあいまい検索
+"""
+
+from array import array
+from collections import Counter
+from itertools import chain
+
+# simstring の CharacterNgramFeatureExtractor と同じ番兵文字
+SENTINEL_CHAR = '\u00a0'
+NGRAM_SIZE = 2
+
+def features(string, n=NGRAM_SIZE):
+    """ 番兵で囲んだ文字列から n-gram の集合を得る """
+    padded = SENTINEL_CHAR + string + SENTINEL_CHAR
+    return {padded[i:i + n] for i in range(len(padded) - n + 1)}
+
+def build_postings(keys, n=NGRAM_SIZE):
+    """ キーのリストから (gram のリスト, オフセット, ポスティング, 特徴数) を作る """
+    postings = {}
+    sizes = []
+    for index, key in enumerate(keys):
+        key_features = features(key, n)
+        sizes.append(len(key_features))
+        for feature in key_features:
+            postings.setdefault(feature, []).append(index)
+    grams = sorted(postings.keys())
+    offsets = [0]
+    flat = []
+    for gram in grams:
+        flat.extend(postings[gram])
+        offsets.append(len(flat))
+    return grams, offsets, flat, sizes
+
+def update_postings(old_keys, old_postings, keys, n=NGRAM_SIZE):
+    """ 前回のキーのリストのポスティングを、新しいキーのリストに合わせて直す
+
+    old_postings は build_postings の結果と同じ形。
+    n-gram を作るのは増えた・消えたキーだけで、他はキー番号を付け替える。
+    結果は build_postings(keys, n) と同じになる
+    """
+    old_grams, old_offsets, old_flat, old_sizes = old_postings
+    key_index = {key: index for index, key in enumerate(keys)}
+    # 前回の番号 -> 今回の番号 (消えたキーは -1)
+    remap = [key_index.get(key, -1) for key in old_keys]
+    # old_keys, keys がどちらもソート済みなら順序は変わらないので、ポスティングを並べ直さなくて良い
+    kept = [index for index in remap if index >= 0]
+    reordered = any(a > b for a, b in zip(kept, kept[1:]))
+    old_key_set = set(old_keys)
+    removed_grams = set()
+    for old_index, index in enumerate(remap):
+        if index < 0:
+            removed_grams.update(features(old_keys[old_index], n))
+    added = {}
+    sizes = [0] * len(keys)
+    for index, key in enumerate(keys):
+        if key in old_key_set:
+            continue
+        key_features = features(key, n)
+        sizes[index] = len(key_features)
+        for feature in key_features:
+            added.setdefault(feature, []).append(index)
+    for old_index, index in enumerate(remap):
+        if index >= 0:
+            sizes[index] = old_sizes[old_index]
+
+    postings = {}
+    for i, gram in enumerate(old_grams):
+        posting = map(remap.__getitem__, old_flat[old_offsets[i]:old_offsets[i + 1]])
+        if gram in removed_grams:
+            posting = [index for index in posting if index >= 0]
+        else:
+            posting = list(posting)
+        if gram in added:
+            posting.extend(added.pop(gram))
+            posting.sort()
+        elif reordered:
+            posting.sort()
+        if posting:
+            postings[gram] = posting
+    postings.update(added)
+    grams = sorted(postings.keys())
+    offsets = [0]
+    flat = []
+    for gram in grams:
+        flat.extend(postings[gram])
+        offsets.append(len(flat))
+    return grams, offsets, flat, sizes
+
+class NgramSearcher:
+    """ n-gram のポスティングを使った Jaccard 類似検索
+
+    simstring の Searcher.ranked_search と同じ [[score, key], ...] を返す
+    """
+    def __init__(self, keys, sizes, lookup, n=NGRAM_SIZE):
+        """ lookup は gram からキー番号の列を返す関数 """
+        self.keys = keys
+        self.sizes = sizes
+        self.lookup = lookup
+        self.n = n
+
+    def ranked_search(self, query_string, alpha):
+        """ 類似度 alpha 以上のキーを類似度順に返す """
+        query_features = features(query_string, self.n)
+        query_size = len(query_features)
+        # 共通 gram 数はポスティングをまとめて Counter に渡して数える (ループは C 側)
+        counts = Counter(chain.from_iterable(self.lookup(feature) for feature in query_features))
+        # どの大きさの候補でも類似度が alpha に届かない共通数は先に落とす
+        lower_bound = alpha * (query_size + 1) / (1 + alpha) - 1e-9
+        keys = self.keys
+        sizes = self.sizes
+        results = []
+        for index, common in counts.items():
+            if common < lower_bound:
+                continue
+            score = common / (query_size + sizes[index] - common)
+            if score >= alpha:
+                results.append([score, keys[index]])
+        results.sort(key=lambda result: (-result[0], result[1]))
+        return results
+
+class Postings(dict):
+    """ gram -> キー番号の列。無い gram には空の列を返す """
+    def __missing__(self, feature):
+        return ()
+
+class NgramIndex(NgramSearcher):
+    """ キーのリストからメモリ上に作る n-gram 索引
+
+    ポスティングは array('I') で持つので pickle しても小さい
+    """
+    def __init__(self, keys, n=NGRAM_SIZE, previous=None):
+        """ previous (前回の NgramIndex) があれば、そのポスティングを直して作る """
+        keys = list(keys)
+        if previous is None or previous.n != n:
+            grams, offsets, flat, sizes = build_postings(keys, n)
+        else:
+            grams, offsets, flat, sizes = update_postings(previous.keys, previous.flat_postings(), keys, n)
+        self.postings = Postings((gram, array('I', flat[offsets[i]:offsets[i + 1]]))
+                                 for i, gram in enumerate(grams))
+        super().__init__(keys, array('I', sizes), self.postings.__getitem__, n)
+
+    def flat_postings(self):
+        """ ポスティングを build_postings の結果と同じ形で得る """
+        grams = list(self.postings.keys())
+        offsets = [0]
+        flat = array('I')
+        for posting in self.postings.values():
+            flat.extend(posting)
+            offsets.append(len(flat))
+        return grams, offsets, flat, self.sizes
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+"""
+永続属性の DynamoDB アダプタ
+
+ウォームなコンテナでは、同じユーザーの AudioPlayer イベントが数秒おきに続けて届く。
+読んだ属性をコンテナ内にキャッシュして、PERSISTENCE_CACHE_TTL の間は GetItem を省く。
+item には version を持たせ、書き込みは version を条件にするので、
+別のコンテナ・端末が先に書いていればキャッシュが古いことに気付ける。
+その時は読み直して、自分の変更を相手の変更に重ねて書き直す。
+"""
+
+import copy
+import itertools
+import os
+import time
+
+from ask_sdk_core.exceptions import PersistenceException
+from ask_sdk_dynamodb.adapter import DynamoDbAdapter
+from botocore.exceptions import ClientError
+
+import metrics
+import util
+
+LOGGER = util.get_logger(__name__)
+
+VERSION_ATTRIBUTE = 'version'
+CACHE_SIZE = int(os.environ.get('PERSISTENCE_CACHE_SIZE', '256'))
+# 他のコンテナ・端末での変更を取りこぼさない様に、キャッシュは短い時間だけ信用する
+CACHE_TTL = float(os.environ.get('PERSISTENCE_CACHE_TTL', '300'))
+# 条件付き書き込みが他の書き込みとぶつかった時に、読み直して書き直す回数
+CONFLICT_RETRIES = int(os.environ.get('PERSISTENCE_CONFLICT_RETRIES', '2'))
+# _merge で消えたキーを表す
+_REMOVED = object()
+
+class CachedDynamoDbAdapter(DynamoDbAdapter):
+    """ version 付きの書き込みスルーキャッシュを持つ DynamoDbAdapter """
+    def __init__(self, *args, cache_size=CACHE_SIZE, cache_ttl=CACHE_TTL, **kwargs):
+        """ initialize """
+        super().__init__(*args, **kwargs)
+        # partition key -> (attributes, version, 読んだ時刻)
+        self.cache = util.LruCache(cache_size)
+        self.cache_ttl = cache_ttl
+        self.conflicts = 0
+
+    def _cached(self, partition_key_val):
+        """ 有効なキャッシュを得る。無ければ None """
+        entry = self.cache.get(partition_key_val)
+        if entry is not None and time.monotonic() - entry[2] > self.cache_ttl:
+            self.cache.discard(partition_key_val)
+            return None
+        return entry
+
+    def cache_stats(self):
+        """ キャッシュの統計を得る """
+        stats = self.cache.stats()
+        stats['conflicts'] = self.conflicts
+        return stats
+
+    def _remember(self, partition_key_val, attributes, version):
+        """ 書いた・読んだ属性をキャッシュする。呼び出し側の変更が移らない様にコピーする """
+        self.cache.put(partition_key_val, (copy.deepcopy(attributes), version, time.monotonic()))
+
+    def _condition(self, version):
+        """ 読んだ時の version のままなら書く、という条件 """
+        if version:
+            return {
+                'ConditionExpression': '#version = :version',
+                'ExpressionAttributeValues': {':version': version},
+            }
+        return {'ConditionExpression': 'attribute_not_exists(#version)'}
+
+    @staticmethod
+    def _is_conflict(error):
+        """ version の条件で書けなかったか """
+        return (isinstance(error, ClientError)
+                and error.response.get('Error', {}).get('Code', '') == 'ConditionalCheckFailedException')
+
+    def _save_failed(self, partition_key_val, error):
+        """ 書き込みの失敗。キャッシュを捨てて PersistenceException にする """
+        self.cache.discard(partition_key_val)
+        if self._is_conflict(error):
+            raise PersistenceException(
+                "Attributes in DynamoDb table {} were updated by another request.".format(
+                    self.table_name))
+        raise PersistenceException(
+            "Failed to save attributes to DynamoDb table. Exception of type {} occurred: {}".format(
+                type(error).__name__, str(error)))
+
+    def _read(self, partition_key_val):
+        """ item を強い整合性で読んでキャッシュする。(属性, version) を返す """
+        try:
+            table = self.dynamodb.Table(self.table_name)
+            response = table.get_item(
+                Key={self.partition_key_name: partition_key_val},
+                ConsistentRead=True)
+        except Exception as error:
+            raise PersistenceException(
+                "Failed to retrieve attributes from DynamoDb table. Exception of type {} occurred: {}".format(
+                    type(error).__name__, str(error)))
+        item = response.get('Item', {})
+        attributes = item.get(self.attribute_name, {})
+        version = int(item.get(VERSION_ATTRIBUTE, 0))
+        self._remember(partition_key_val, attributes, version)
+        return attributes, version
+
+    def get_attributes(self, request_envelope):
+        """ キャッシュにあればそれを、無ければ DynamoDB から読む
+
+        キャッシュが古くても、書く時の version の条件で気付いて読み直す
+        """
+        partition_key_val = self.partition_keygen(request_envelope)
+        entry = self._cached(partition_key_val)
+        if entry is not None:
+            metrics.count('persistence_cache_hit')
+            return copy.deepcopy(entry[0])
+        metrics.count('persistence_cache_miss')
+        return self._read(partition_key_val)[0]
+
+    def _base(self, partition_key_val):
+        """ 書き込みの元にする (属性, version)。キャッシュが無ければ読み直す """
+        entry = self._cached(partition_key_val)
+        if entry is None:
+            return self._read(partition_key_val)
+        return entry[0], entry[1]
+
+    def _retry_conflict(self, partition_key_val, error, attempt):
+        """ 他の書き込みとぶつかったら読み直して (属性, version) を返す。諦める時は例外にする """
+        if not self._is_conflict(error) or attempt >= CONFLICT_RETRIES:
+            self._save_failed(partition_key_val, error)
+        self.conflicts += 1
+        metrics.count('persistence_conflict')
+        LOGGER.warning("attributes were updated by another request, retry (%d)", attempt + 1)
+        return self._read(partition_key_val)
+
+    @staticmethod
+    def _merge(base, attributes, fresh):
+        """ base から attributes への変更を fresh に重ねる。同じキーを両方が違う値に変えていたら None """
+        merged = copy.deepcopy(fresh)
+        for key in set(base) | set(attributes):
+            if key in attributes and (key not in base or base[key] != attributes[key]):
+                value = attributes[key]
+            elif key not in attributes and key in base:
+                value = _REMOVED
+            else:
+                continue
+            theirs = fresh.get(key, _REMOVED)
+            if theirs != base.get(key, _REMOVED) and theirs != value:
+                return None
+            if value is _REMOVED:
+                merged.pop(key, None)
+            else:
+                merged[key] = copy.deepcopy(value)
+        return merged
+
+    def save_attributes(self, request_envelope, attributes):
+        """ version を条件に item を丸ごと書く
+
+        他が先に書いていたら読み直して、読んだ時からの自分の変更を重ねて書き直す。
+        同じキーを両方が変えていたら、他の書き込みを上書きせずに PersistenceException にする
+        """
+        partition_key_val = self.partition_keygen(request_envelope)
+        base, version = self._base(partition_key_val)
+        for attempt in itertools.count():
+            try:
+                table = self.dynamodb.Table(self.table_name)
+                table.put_item(
+                    Item={self.partition_key_name: partition_key_val,
+                          self.attribute_name: attributes,
+                          VERSION_ATTRIBUTE: version + 1},
+                    ExpressionAttributeNames={'#version': VERSION_ATTRIBUTE},
+                    **self._condition(version))
+                break
+            except ClientError as error:
+                fresh, version = self._retry_conflict(partition_key_val, error, attempt)
+                merged = self._merge(base, attributes, fresh)
+                if merged is None:
+                    # 同じ所を他のリクエストも変えた。次のリクエストは読み直した属性を使う
+                    LOGGER.warning("attributes were changed by another request, not saved")
+                    self._save_failed(partition_key_val, error)
+                base = fresh
+                attributes.clear()
+                attributes.update(merged)
+            except Exception as error:
+                self._save_failed(partition_key_val, error)
+        self._remember(partition_key_val, attributes, version + 1)
+
+    def update_attributes(self, request_envelope, attributes, name, values, removed=(), volatile=()):
+        """ attributes[name] の一部のフィールドだけを UpdateItem で書く
+
+        values は {フィールド: 値}、removed は消すフィールド。
+        attributes は書いた後の属性全体で、キャッシュに使う。
+        他が先に書いていたら読み直して、そちらの属性に values, removed だけを重ねる。
+        ただし name の volatile 以外のフィールドが変わっていたら、他の書き込みを残す。
+        まだ item が無い等で部分的に書けない時は False を返す
+        """
+        partition_key_val = self.partition_keygen(request_envelope)
+        version = self._base(partition_key_val)[1]
+        for attempt in itertools.count():
+            if not version:
+                return False
+            try:
+                self._update_item(partition_key_val, version, name, values, removed)
+                break
+            except ClientError as error:
+                if error.response.get('Error', {}).get('Code', '') == 'ValidationException':
+                    # name の map が無い等
+                    LOGGER.warning("update_item failed (%s), fall back to put_item", error)
+                    return False
+                fresh, version = self._retry_conflict(partition_key_val, error, attempt)
+                fresh = copy.deepcopy(fresh)
+                merged = set(values) | set(removed) | set(volatile)
+                if (not isinstance(fresh.get(name, None), dict)
+                        or self._unmerged(fresh, name, merged) != self._unmerged(attributes, name, merged)):
+                    # 他のリクエストが name を作り直した (別の曲を再生し始めた等)。そちらを残す
+                    LOGGER.warning("%s was replaced by another request, keep it", name)
+                    attributes.clear()
+                    attributes.update(fresh)
+                    return True
+                # 読み直した属性に書く値を重ねたものが、書いた後の属性になる
+                fresh[name].update(values)
+                for field in removed:
+                    fresh[name].pop(field, None)
+                attributes.clear()
+                attributes.update(fresh)
+        self._remember(partition_key_val, attributes, version + 1)
+        return True
+
+    @staticmethod
+    def _unmerged(attributes, name, merged):
+        """ attributes の name 以外と、attributes[name] の merged 以外のフィールド """
+        others = {key: value for key, value in attributes.items() if key != name}
+        fields = {key: value for key, value in attributes[name].items() if key not in merged}
+        return others, fields
+
+    def _update_item(self, partition_key_val, version, name, values, removed):
+        """ version を条件に attributes[name] のフィールドを UpdateItem で書く """
+        names = {'#attr': self.attribute_name, '#name': name, '#version': VERSION_ATTRIBUTE}
+        condition = self._condition(version)
+        expression_values = dict(condition['ExpressionAttributeValues'])
+        expression_values[':next'] = version + 1
+        set_expressions = ['#version = :next']
+        remove_expressions = []
+        for i, field in enumerate(sorted(values)):
+            names['#f{}'.format(i)] = field
+            set_expressions.append('#attr.#name.#f{} = :v{}'.format(i, i))
+            expression_values[':v{}'.format(i)] = values[field]
+        for i, field in enumerate(sorted(removed)):
+            names['#r{}'.format(i)] = field
+            remove_expressions.append('#attr.#name.#r{}'.format(i))
+        update_expression = 'SET ' + ', '.join(set_expressions)
+        if remove_expressions:
+            update_expression += ' REMOVE ' + ', '.join(remove_expressions)
+        table = self.dynamodb.Table(self.table_name)
+        table.update_item(
+            Key={self.partition_key_name: partition_key_val},
+            UpdateExpression=update_expression,
+            ConditionExpression=condition['ConditionExpression'],
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=expression_values)
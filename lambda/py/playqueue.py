@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+"""
+再生キュー
+
+永続化するのは再生対象 (type, id) とシャッフルの seed、再生位置などの小さな
+値だけで、曲リストは MusicDb から組み立て直す。seed が同じなら同じ順序になる。
+"""
+
+import copy
+import os
+import random
+import util
+
+LOGGER = util.get_logger(__name__)
+
+# DynamoDB からは Decimal で戻ってくる
+INT_FIELDS = ['index', 'seed', 'playback_failure_count', 'offset_in_milliseconds', 'count']
+# 組み立てた曲リストは、同じコンテナに続けて来るイベントで使い回す
+TITLE_LIST_CACHE = util.LruCache(int(os.environ.get('TITLE_LIST_CACHE_SIZE', '16')))
+# 再生中に変わるだけの値。これだけの変更なら item を書き直さずに UpdateItem で済ませる
+PLAYBACK_FIELDS = {'index', 'state', 'now_playing', 'offset_in_milliseconds', 'playback_failure_count'}
+
+def new_seed():
+    """ シャッフル用の seed を作る """
+    return random.randrange(1 << 31)
+
+def make_token(index, title_id):
+    """ 再生位置を埋め込んだストリームのトークン "位置:曲ID" を作る """
+    return '{}:{}'.format(index, title_id)
+
+def parse_token(token):
+    """ トークンから (位置, 曲ID) を得る。曲IDだけの古いトークンなら位置は None """
+    if not token:
+        return None, token
+    index, separator, title_id = token.partition(':')
+    if not separator or not index.isdigit():
+        return None, token
+    return int(index), title_id
+
+def create_attributes(play_list):
+    """ MusicSearch.expansion_list 済みの検索結果から、永続化する再生キューを作る """
+    return {
+        'type': play_list['type'],
+        'id': play_list['id'],
+        'seed': play_list.get('seed', None),
+        'include_karaoke': play_list.get('include_karaoke', False),
+        'can_shuffle': play_list['can_shuffle'],
+        'count': len(play_list['list']),
+        'index': 0,
+        'state': 'PLAY_REQUEST',
+        'playback_failure_count': 0,
+    }
+
+
+class PlayQueue:
+    """ 永続属性の play_queue を包んで、曲リストを必要になった時に組み立てる
+
+    attributes は persistent_attributes['play_queue'] そのもので、
+    q['state'] = ... の様な変更はそのまま永続属性に反映される
+    """
+    def __init__(self, attributes, music_search):
+        """ initialize """
+        info = attributes.pop('info', None)
+        if info:
+            # 検索結果を丸ごと保存していた頃の形式
+            attributes.setdefault('type', info['type'])
+            attributes.setdefault('id', info['id'])
+            attributes.setdefault('can_shuffle', info.get('can_shuffle', False))
+        for field in INT_FIELDS:
+            if attributes.get(field, None) is not None:
+                attributes[field] = int(attributes[field])
+        self.attributes = attributes
+        self.music_search = music_search
+        self._title_list = None
+
+    def __getitem__(self, key):
+        return self.attributes[key]
+
+    def __setitem__(self, key, value):
+        self.attributes[key] = value
+
+    def __contains__(self, key):
+        return key in self.attributes
+
+    def get(self, key, default=None):
+        """ dict.get と同じ """
+        return self.attributes.get(key, default)
+
+    def __str__(self):
+        return str(self.attributes)
+
+    def queue_key(self):
+        """ 曲リストを決める値の組。同じなら同じ曲リストになる """
+        return (self.get('type', None), self.get('id', None), self.get('seed', None),
+                self.get('include_karaoke', False), tuple(self.get('list', ())))
+
+    @property
+    def title_list(self):
+        """ 曲IDのリスト """
+        if self._title_list is None:
+            if 'list' in self.attributes:
+                # 曲リストを丸ごと保存していた頃の形式
+                self._title_list = self.attributes['list']
+            else:
+                TITLE_LIST_CACHE.validate(self.music_search.get_db().get_version())
+                queue_key = self.queue_key()
+                self._title_list = TITLE_LIST_CACHE.get(queue_key)
+                if self._title_list is None:
+                    self._title_list = self.music_search.build_title_list(
+                        self['type'], self['id'], seed=self.get('seed', None),
+                        include_karaoke=self.get('include_karaoke', False))
+                    TITLE_LIST_CACHE.put(queue_key, self._title_list)
+                if self.get('count', None) not in (None, len(self._title_list)):
+                    LOGGER.warning("play_queue: title list changed %s -> %d",
+                                   self['count'], len(self._title_list))
+        return self._title_list
+
+    def current_title_id(self):
+        """ 再生位置の曲ID """
+        title_list = self.title_list
+        return title_list[self['index'] % len(title_list)]
+
+    def current_token(self):
+        """ 再生位置のトークン """
+        return make_token(self['index'] % len(self.title_list), self.current_title_id())
+
+    def upcoming(self, count):
+        """ 再生位置から count 曲分の (位置, 曲ID) のリスト。末尾からは先頭に戻る """
+        title_list = self.title_list
+        count = min(count, len(title_list))
+        return [((self['index'] + i) % len(title_list), title_list[(self['index'] + i) % len(title_list)])
+                for i in range(count)]
+
+    def position_of(self, token):
+        """ トークンの曲がリストの何番目かを得る。見つからなければ None
+
+        トークンに位置が入っていれば、その位置の曲IDを確かめるだけで済む。
+        同じ曲がリストに何度あっても、再生した位置が分かる
+        """
+        index, title_id = parse_token(token)
+        title_list = self.title_list
+        if index is not None:
+            if index < len(title_list) and title_list[index] == title_id:
+                return index
+            return None
+        # 位置の入っていない古いトークン
+        try:
+            return title_list.index(title_id)
+        except ValueError:
+            return None
+
+    def set_shuffle(self, shuffle):
+        """ シャッフルの切り替え。先頭から再生し直す """
+        self.attributes.pop('list', None)
+        self['seed'] = new_seed() if shuffle else None
+        self['is_shuffle'] = shuffle
+        self['index'] = 0
+        self._title_list = None
+
+
+class PlayQueueStore:
+    """ 永続属性の読み書きを受け持つ。リクエストの始めの値と比べて、変わった所だけを書く
+
+    - 何も変わっていなければ書かない
+    - play_queue の PLAYBACK_FIELDS だけが変わったなら、その値だけを
+      アダプタの update_attributes (persistence.CachedDynamoDbAdapter) で書く
+    - それ以外は今まで通り save_persistent_attributes で item を丸ごと書く
+    """
+    def __init__(self, attributes_manager, music_search, adapter=None, request_envelope=None):
+        """ initialize
+
+        adapter と request_envelope は play_queue のフィールドだけを書く時に使う。
+        adapter が update_attributes を持たなければ、いつも item を丸ごと書く
+        """
+        self.attributes_manager = attributes_manager
+        self.music_search = music_search
+        self.adapter = adapter
+        self.request_envelope = request_envelope
+        self.attributes = attributes_manager.persistent_attributes
+        self.saved = copy.deepcopy(self.attributes)
+        self._play_queue = None
+        self.stats = {'skipped': 0, 'updated': 0, 'saved': 0}
+
+    def get_play_queue(self):
+        """ 再生キューを PlayQueue で得る。空なら None """
+        attributes = self.attributes.get('play_queue', None)
+        if not attributes:
+            return None
+        if self._play_queue is None or self._play_queue.attributes is not attributes:
+            self._play_queue = PlayQueue(attributes, self.music_search)
+        return self._play_queue
+
+    def set_play_queue(self, attributes):
+        """ 再生キューを置き換える """
+        self.attributes['play_queue'] = attributes
+        self._play_queue = None
+
+    def changed_fields(self):
+        """ 変わった play_queue のフィールド名の集合を得る。丸ごと書くべき時は None """
+        old_queue = self.saved.get('play_queue', None)
+        new_queue = self.attributes.get('play_queue', None)
+        if not old_queue or not new_queue:
+            return None if old_queue != new_queue else set()
+        others = set(self.attributes.keys()) | set(self.saved.keys())
+        others.discard('play_queue')
+        if any(self.attributes.get(key, None) != self.saved.get(key, None) for key in others):
+            return None
+        return {key for key in set(old_queue.keys()) | set(new_queue.keys())
+                if old_queue.get(key, None) != new_queue.get(key, None)}
+
+    def save(self):
+        """ 変わった所だけを保存する """
+        fields = self.changed_fields()
+        if fields is not None and not fields:
+            self.stats['skipped'] += 1
+            LOGGER.debug("play_queue: not changed, skip save")
+            return
+        if fields is not None and fields <= PLAYBACK_FIELDS and self._update_fields(fields):
+            self.stats['updated'] += 1
+        else:
+            self.attributes_manager.save_persistent_attributes()
+            self.stats['saved'] += 1
+        self.saved = copy.deepcopy(self.attributes)
+
+    def _update_fields(self, fields):
+        """ アダプタが update_attributes を持っていれば fields だけを書く。書けなければ False """
+        update_attributes = getattr(self.adapter, 'update_attributes', None)
+        if update_attributes is None:
+            return False
+        play_queue = self.attributes['play_queue']
+        values = {field: play_queue[field] for field in fields if field in play_queue}
+        removed = [field for field in fields if field not in play_queue]
+        return update_attributes(self.request_envelope, self.attributes,
+                                 'play_queue', values, removed, volatile=PLAYBACK_FIELDS)
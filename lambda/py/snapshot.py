@@ -0,0 +1,679 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+"""
+MusicDb のスナップショット(バイナリ形式)の読み書き
+
+ファイルの構成は次の通り。
+
+    MAGIC(8byte) | 形式バージョン(uint32) | ディレクトリ長(uint32) | ディレクトリ(JSON) | セクション...
+
+ディレクトリには各セクションの位置と型を記録する。セクションは 8byte 境界に
+置き、読み込み時は mmap 上の memoryview としてそのまま参照するので、
+オープン時にはディレクトリ以外のパースを行わない。レコードは参照された時に
+だけ JSON からデコードする。
+"""
+
+import array
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import zlib
+from collections import OrderedDict
+from collections.abc import Mapping, Sequence
+import ngram
+
+MAGIC = b'MHSNAP\x00\x00'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<8sII')
+ALIGNMENT = 8
+ITEM_TYPES = ['artist', 'album', 'title']
+# シャード分割する時にシャードのファイルに置くレコードテーブル
+SHARD_TABLES = ['music.artist', 'music.album', 'music.title', 'artist_title']
+
+class SnapshotError(Exception):
+    """ スナップショットが読めない """
+
+
+def shard_of(item_id, shards):
+    """ ID のレコードを置くシャードの番号
+
+    生成した ID は ART00000001 の様に先頭が揃っているので、先頭ではなくハッシュで分ける
+    """
+    return zlib.crc32(item_id.encode('utf-8')) % shards
+
+def shard_path(path, index):
+    """ シャードのファイル名 (database.snap -> database-000.snap) """
+    base, ext = os.path.splitext(path)
+    return '{}-{:03d}{}'.format(base, index, ext)
+
+
+def _encode_array(typecode, values):
+    """ 数値列をリトルエンディアンのバイト列にする """
+    arr = array.array(typecode, values)
+    if sys.byteorder != 'little':
+        arr.byteswap()
+    return arr.tobytes()
+
+def _encode_json(obj):
+    """ レコードをコンパクトな JSON にする """
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+
+
+class SnapshotWriter:
+    """ スナップショットを組み立てて書き出す """
+    def __init__(self):
+        """ initialize """
+        self.sections = OrderedDict()
+        self.meta = {}
+
+    def add_bytes(self, name, data):
+        """ バイト列のセクションを追加する """
+        self.sections[name] = ('B', bytes(data))
+
+    def add_array(self, name, typecode, values):
+        """ 数値配列のセクションを追加する """
+        self.sections[name] = (typecode, _encode_array(typecode, values))
+
+    def add_strings(self, name, strings):
+        """ 文字列テーブル(オフセット + UTF-8 データ)を追加する """
+        offsets = [0]
+        data = bytearray()
+        for string in strings:
+            data += string if isinstance(string, bytes) else string.encode('utf-8')
+            offsets.append(len(data))
+        self.add_array(name + '.off', 'I', offsets)
+        self.add_bytes(name + '.dat', data)
+
+    def add_records(self, name, records, previous=None, affected=None):
+        """ ID でソートしたレコードテーブルを追加する
+
+        previous (前回の RecordTable) を渡すと、増えた・消えた・変わった ID を返す。
+        affected (変わったかもしれない ID の集合) も渡すと、それ以外の前回からある
+        ID はエンコードせずに前回のレコードをそのまま使う
+        """
+        ids = sorted(records.keys())
+        if previous is None:
+            self.add_strings(name + '.key', ids)
+            self.add_strings(name + '.rec', [_encode_json(records[item_id]).encode('utf-8') for item_id in ids])
+            return None
+        old_index = {item_id: index for index, item_id in enumerate(previous.keys_table)}
+        changes = {'added': [], 'removed': [], 'changed': []}
+        encoded = []
+        for item_id in ids:
+            index = old_index.pop(item_id, None)
+            if index is not None and affected is not None and item_id not in affected:
+                encoded.append(previous.raw(index))
+                continue
+            record = _encode_json(records[item_id]).encode('utf-8')
+            if index is None:
+                changes['added'].append(item_id)
+            elif previous.raw(index) != record:
+                changes['changed'].append(item_id)
+            encoded.append(record)
+        changes['removed'] = sorted(old_index.keys())
+        self.add_strings(name + '.key', ids)
+        self.add_strings(name + '.rec', encoded)
+        return changes
+
+    def add_names(self, name, name_dict):
+        """ 名前 -> {'id', 'priority'} の辞書を追加する
+
+        キーはソートして格納し、辞書の挿入順は order に残す
+        """
+        keys = sorted(name_dict.keys())
+        rank = {key: i for i, key in enumerate(name_dict.keys())}
+        id_table = {}
+        for entry in name_dict.values():
+            id_table.setdefault(entry['id'], len(id_table))
+        self.add_strings(name + '.key', keys)
+        self.add_strings(name + '.ids', list(id_table.keys()))
+        self.add_array(name + '.id', 'I', [id_table[name_dict[key]['id']] for key in keys])
+        self.add_array(name + '.pri', 'B', [name_dict[key]['priority'] for key in keys])
+        self.add_array(name + '.order', 'I', sorted(range(len(keys)), key=lambda i: rank[keys[i]]))
+        self.add_array(name + '.rank', 'I', [rank[key] for key in keys])
+        return keys
+
+    def add_postings(self, name, keys, n=ngram.NGRAM_SIZE, previous=None):
+        """ キーの n-gram ポスティングを追加する
+
+        previous (前回の (キー, ポスティング)) があれば、それを直して作る
+        """
+        if previous is None:
+            grams, offsets, postings, sizes = ngram.build_postings(keys, n)
+        else:
+            grams, offsets, postings, sizes = ngram.update_postings(previous[0], previous[1], keys, n)
+        self.add_strings(name + '.gram', grams)
+        self.add_array(name + '.off', 'I', offsets)
+        self.add_array(name + '.post', 'I', postings)
+        self.add_array(name + '.size', 'I', sizes)
+
+    def version(self):
+        """ セクションの内容から版を決める """
+        digest = hashlib.sha1()
+        for name, (typecode, data) in self.sections.items():
+            digest.update(name.encode('utf-8'))
+            digest.update(typecode.encode('ascii'))
+            digest.update(data)
+        self.meta['version'] = digest.hexdigest()[:16]
+        return self.meta['version']
+
+    def write(self, path):
+        """ ファイルに書き出す """
+        self.version()
+
+        # ディレクトリの長さがオフセットに影響するので、長さが落ち着くまで組み立て直す
+        layout = OrderedDict()
+        directory = b''
+        while True:
+            position = HEADER.size + len(directory)
+            for name, (typecode, data) in self.sections.items():
+                position += -position % ALIGNMENT
+                layout[name] = [position, len(data), typecode]
+                position += len(data)
+            rebuilt = json.dumps({'meta': self.meta, 'sections': layout},
+                                 ensure_ascii=False).encode('utf-8')
+            if len(rebuilt) == len(directory):
+                directory = rebuilt
+                break
+            directory = rebuilt
+        # 前回のスナップショットを mmap で開いたままでも壊さない様に、別名で書いて置き換える
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as file_pointer:
+            file_pointer.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(directory)))
+            file_pointer.write(directory)
+            for name, (typecode, data) in self.sections.items():
+                file_pointer.write(b'\x00' * (layout[name][0] - file_pointer.tell()))
+                file_pointer.write(data)
+        os.replace(temp_path, path)
+        return self.meta['version']
+
+
+class StringTable(Sequence):
+    """ 文字列テーブルの読み出し """
+    def __init__(self, offsets, data):
+        """ initialize """
+        self._offsets = offsets
+        self._data = data
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        return str(self._data[self._offsets[index]:self._offsets[index + 1]], 'utf-8')
+
+    def raw(self, index):
+        """ UTF-8 のまま得る """
+        return bytes(self._data[self._offsets[index]:self._offsets[index + 1]])
+
+    def find(self, string):
+        """ ソート済みテーブルから二分探索する。無ければ -1 """
+        # UTF-8 のバイト順はコードポイント順と一致する
+        target = string.encode('utf-8')
+        low, high = 0, len(self)
+        while low < high:
+            mid = (low + high) // 2
+            if self.raw(mid) < target:
+                low = mid + 1
+            else:
+                high = mid
+        if low < len(self) and self.raw(low) == target:
+            return low
+        return -1
+
+
+class RecordTable(Mapping):
+    """ ID -> レコード。参照時にデコードする """
+    def __init__(self, keys, records):
+        """ initialize """
+        self._keys = keys
+        self._records = records
+
+    def __getitem__(self, item_id):
+        index = self._keys.find(item_id)
+        if index < 0:
+            raise KeyError(item_id)
+        return json.loads(self._records[index])
+
+    @property
+    def keys_table(self):
+        """ ソート済みの ID の文字列テーブル """
+        return self._keys
+
+    def raw(self, index):
+        """ ソート順の番号のレコードを UTF-8 の JSON のまま得る """
+        return self._records.raw(index)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+
+class NameTable(Mapping):
+    """ 名前 -> {'id', 'priority'}。反復は元の辞書の挿入順 """
+    def __init__(self, keys, id_table, ids, priorities, order, ranks=None):
+        """ initialize """
+        self.keys_table = keys
+        self._id_table = id_table
+        self._ids = ids
+        self._priorities = priorities
+        self._order = order
+        self.ranks = ranks
+
+    def entry_at(self, index):
+        """ ソート順の番号からエントリを得る """
+        return {'id': self._id_table[self._ids[index]], 'priority': self._priorities[index]}
+
+    def __getitem__(self, key):
+        index = self.keys_table.find(key)
+        if index < 0:
+            raise KeyError(key)
+        return self.entry_at(index)
+
+    def __iter__(self):
+        keys = self.keys_table
+        return (keys[index] for index in self._order)
+
+    def __len__(self):
+        return len(self.keys_table)
+
+
+class SubstringIndex:
+    """ 名前辞書の部分一致検索
+
+    1文字の検索は 1-gram の、2文字以上の検索は 2-gram のポスティングの積から
+    候補を絞り、実際に含まれているかを確かめる
+    """
+    def __init__(self, names, unigram_lookup, bigram_lookup):
+        """ initialize """
+        self.names = names
+        self.unigram_lookup = unigram_lookup
+        self.bigram_lookup = bigram_lookup
+
+    def _candidates(self, string):
+        """ string を含む可能性のあるキー番号 """
+        if not string:
+            return range(len(self.names))
+        if len(string) == 1:
+            return self.unigram_lookup(string)
+        postings = sorted((self.bigram_lookup(string[i:i + 2]) for i in range(len(string) - 1)),
+                          key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            if not candidates:
+                break
+            candidates.intersection_update(posting)
+        return candidates
+
+    def search(self, string):
+        """ string を含むキーの番号の集合 """
+        keys = self.names.keys_table
+        return {index for index in self._candidates(string) if string in keys[index]}
+
+    def matches(self, entry_name, norm_name):
+        """ 全文検索。辞書を先頭から走査した時と同じ順で (id, priority) を返す
+
+        entry_name を含むキーは priority、norm_name を含むキーは priority + 10
+        """
+        names = self.names
+        by_name = self.search(entry_name)
+        by_norm = self.search(norm_name)
+        result = []
+        for index in sorted(by_name | by_norm, key=lambda index: names.ranks[index]):
+            entry = names.entry_at(index)
+            if index in by_name:
+                result.append((entry['id'], entry['priority']))
+            if index in by_norm:
+                result.append((entry['id'], entry['priority'] + 10))
+        return result
+
+
+class Snapshot:
+    """ スナップショットを mmap で開く """
+    def __init__(self, path):
+        """ initialize """
+        with open(path, 'rb') as file_pointer:
+            self._mmap = mmap.mmap(file_pointer.fileno(), 0, access=mmap.ACCESS_READ)
+        self._buffer = memoryview(self._mmap)
+        magic, format_version, directory_length = HEADER.unpack_from(self._buffer, 0)
+        if magic != MAGIC:
+            raise SnapshotError('not a snapshot: {}'.format(path))
+        if format_version != FORMAT_VERSION:
+            raise SnapshotError('unsupported format version: {}'.format(format_version))
+        start = HEADER.size
+        directory = json.loads(str(self._buffer[start:start + directory_length], 'utf-8'))
+        self.meta = directory['meta']
+        self.sections = directory['sections']
+        self.version = self.meta['version']
+
+    def close(self):
+        """ mmap を閉じる。セクションの memoryview が残っていれば閉じない """
+        try:
+            self._buffer.release()
+            self._mmap.close()
+        except BufferError:
+            pass
+
+    def section(self, name):
+        """ セクションを memoryview で得る """
+        offset, length, typecode = self.sections[name]
+        view = self._buffer[offset:offset + length]
+        if typecode == 'B':
+            return view
+        if sys.byteorder != 'little':
+            arr = array.array(typecode, view.tobytes())
+            arr.byteswap()
+            return arr
+        return view.cast(typecode)
+
+    def has(self, name):
+        """ セクションがあるか """
+        return name in self.sections
+
+    def lookup(self, name):
+        """ ポスティングから gram -> キー番号の列 を引く関数を得る """
+        grams = self.strings(name + '.gram')
+        offsets = self.section(name + '.off')
+        postings = self.section(name + '.post')
+        def lookup(feature):
+            index = grams.find(feature)
+            if index < 0:
+                return ()
+            return postings[offsets[index]:offsets[index + 1]]
+        return lookup
+
+    def shards(self):
+        """ シャードの一覧 [{'version', 'size', 'counts'}, ...]。分割していなければ空 """
+        if not self.has('shards'):
+            return []
+        return json.loads(str(self.section('shards'), 'utf-8'))
+
+    def postings(self, name):
+        """ ポスティングを build_postings の結果と同じ形で得る """
+        return (self.strings(name + '.gram'), self.section(name + '.off'),
+                self.section(name + '.post'), self.section(name + '.size'))
+
+    def strings(self, name):
+        """ 文字列テーブルを得る """
+        return StringTable(self.section(name + '.off'), self.section(name + '.dat'))
+
+    def table(self, name):
+        """ レコードテーブルを得る """
+        return RecordTable(self.strings(name + '.key'), self.strings(name + '.rec'))
+
+    def records(self, item_type):
+        """ music.<item_type> のレコードテーブルを得る """
+        return self.table('music.' + item_type)
+
+    def names(self, item_type):
+        """ 名前辞書を得る """
+        name = 'name.' + item_type
+        ranks = self.section(name + '.rank') if self.has(name + '.rank') else None
+        return NameTable(self.strings(name + '.key'), self.strings(name + '.ids'),
+                         self.section(name + '.id'), self.section(name + '.pri'),
+                         self.section(name + '.order'), ranks)
+
+    def searcher(self, item_type):
+        """ 名前辞書に対する n-gram 検索器を得る """
+        name = 'ngram.' + item_type
+        return ngram.NgramSearcher(self.strings('name.' + item_type + '.key'),
+                                   self.section(name + '.size'), self.lookup(name))
+
+    def substring_index(self, item_type, names):
+        """ 名前辞書の部分一致索引を得る。古いスナップショットでは None """
+        if not self.has('sub.' + item_type + '.off') or names.ranks is None:
+            return None
+        return SubstringIndex(names, self.lookup('sub.' + item_type),
+                              self.lookup('ngram.' + item_type))
+
+
+class ShardSet:
+    """ シャードのファイルを参照された時に開く
+
+    開いているシャードのファイルの大きさの合計が budget (バイト) を超えたら、
+    最も前に使ったものから閉じる。mmap を閉じればその分の常駐メモリも返る
+    """
+    def __init__(self, path, shards, budget):
+        """ shards は Snapshot.shards() の一覧 """
+        self.path = path
+        self.shards = shards
+        self.budget = budget
+        # 番号 -> [Snapshot, {テーブル名: RecordTable}, 大きさ]
+        self.opened = OrderedDict()
+        self.size = 0
+        self.loads = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.shards)
+
+    def table(self, index, name):
+        """ index 番のシャードのテーブルを得る。無いテーブルは空 """
+        entry = self.opened.get(index, None)
+        if entry is None:
+            entry = self._open(index)
+        else:
+            self.opened.move_to_end(index)
+        tables = entry[1]
+        if name not in tables:
+            tables[name] = entry[0].table(name) if entry[0].has(name + '.key.off') else {}
+        return tables[name]
+
+    def _open(self, index):
+        """ シャードを開く。予算を超える分は古いものから閉じる (開くものは必ず残す) """
+        size = self.shards[index]['size']
+        while self.opened and self.size + size > self.budget:
+            _, entry = self.opened.popitem(last=False)
+            self._close(entry)
+            self.evictions += 1
+        path = shard_path(self.path, index)
+        shard = Snapshot(path)
+        if shard.version != self.shards[index]['version']:
+            shard.close()
+            raise SnapshotError('shard version mismatch: {}'.format(path))
+        entry = [shard, {}, size]
+        self.opened[index] = entry
+        self.size += size
+        self.loads += 1
+        return entry
+
+    def _close(self, entry):
+        """ シャードを閉じる """
+        shard, tables, size = entry
+        tables.clear()
+        shard.close()
+        self.size -= size
+
+    def clear(self):
+        """ 全て閉じる """
+        while self.opened:
+            _, entry = self.opened.popitem(last=False)
+            self._close(entry)
+
+    def stats(self):
+        """ 統計を得る """
+        return {'shards': len(self.shards), 'opened': len(self.opened), 'size': self.size,
+                'loads': self.loads, 'evictions': self.evictions}
+
+
+class ShardedTable(Mapping):
+    """ シャードに分けたレコードテーブル。ID -> レコード """
+    def __init__(self, shard_set, name):
+        """ initialize """
+        self.shard_set = shard_set
+        self.name = name
+
+    def __getitem__(self, item_id):
+        return self.shard_set.table(shard_of(item_id, len(self.shard_set)), self.name)[item_id]
+
+    def __iter__(self):
+        for index in range(len(self.shard_set)):
+            table = self.shard_set.table(index, self.name)
+            # 次のシャードを開いた時に閉じられても良い様に、ID は先にコピーする
+            item_ids = list(table.keys_table) if isinstance(table, RecordTable) else []
+            for item_id in item_ids:
+                yield item_id
+
+    def __len__(self):
+        return sum(shard['counts'].get(self.name, 0) for shard in self.shard_set.shards)
+
+
+def read_records(path, name, item_ids):
+    """ path のスナップショット (シャードに分けたものも) から name のレコードを読む
+
+    {ID: レコード} を返す。無い ID は含めない。読み終わったらファイルは閉じる
+    """
+    snapshot = Snapshot(path)
+    shard_set = None
+    table = {}
+    try:
+        shards = snapshot.shards()
+        if shards:
+            shard_set = ShardSet(path, shards, sum(shard['size'] for shard in shards))
+            table = ShardedTable(shard_set, name)
+        elif snapshot.has(name + '.key.off'):
+            table = snapshot.table(name)
+        records = {}
+        for item_id in item_ids:
+            try:
+                records[item_id] = table[item_id]
+            except KeyError:
+                pass
+        return records
+    finally:
+        # memoryview が残っていると mmap を閉じられない
+        table = None
+        if shard_set is not None:
+            shard_set.clear()
+        snapshot.close()
+
+
+def item_sections(database, item_type, previous=None, records=True, affected=None):
+    """ 1種類分 (名前辞書・n-gram・レコード) のセクションを作る
+
+    種類ごとに独立しているので別プロセスで作れる。previous (前回の Snapshot) が
+    あれば n-gram のポスティングはそれを直して作り、前回からの変更も返す。
+    affected (テーブル名 -> 変わったかもしれない ID の集合) があれば、
+    それ以外のレコードは前回のものを使う。
+    records が偽ならレコードテーブルは作らない (シャードに置く時)
+    """
+    writer = SnapshotWriter()
+    keys = writer.add_names('name.' + item_type, database[item_type])
+    old_keys = None
+    if previous is not None and previous.has('sub.' + item_type + '.off'):
+        old_keys = list(previous.strings('name.' + item_type + '.key'))
+    for name, n in [('ngram.' + item_type, ngram.NGRAM_SIZE), ('sub.' + item_type, 1)]:
+        writer.add_postings(name, keys, n, None if old_keys is None else (old_keys, previous.postings(name)))
+    changes = None
+    if records:
+        old_records = None
+        if previous is not None and previous.has('music.' + item_type + '.key.off'):
+            old_records = previous.records(item_type)
+        changes = writer.add_records('music.' + item_type, database['music'][item_type], old_records,
+                                     (affected or {}).get('music.' + item_type, None))
+    if previous is not None:
+        old_key_set = set(old_keys if old_keys is not None else previous.strings('name.' + item_type + '.key'))
+        key_set = set(keys)
+        changes = dict(changes or {}, names={'added': sorted(key_set - old_key_set),
+                                             'removed': sorted(old_key_set - key_set)})
+    return list(writer.sections.items()), changes
+
+def extra_sections(database, records=True, previous=None, affected=None):
+    """ 種類によらないセクション (artist_title, meta) を作る
+
+    previous, affected は item_sections と同じ
+    """
+    writer = SnapshotWriter()
+    for name in ['artist_title', 'meta']:
+        if name in database and (records or name not in SHARD_TABLES):
+            old_records = None
+            if previous is not None and previous.has(name + '.key.off'):
+                old_records = previous.table(name)
+            writer.add_records(name, database[name], old_records, (affected or {}).get(name, None))
+    return list(writer.sections.items())
+
+def table_records(database, table):
+    """ SHARD_TABLES の名前のレコードの辞書 """
+    if table.startswith('music.'):
+        return database['music'][table[len('music.'):]]
+    return database.get(table, None)
+
+def partition_records(database, shards):
+    """ レコードをシャードごとに分ける。[{テーブル名: {ID: レコード}}, ...] """
+    partitions = [{} for _ in range(shards)]
+    for table in SHARD_TABLES:
+        records = table_records(database, table)
+        if records is None:
+            continue
+        for partition in partitions:
+            partition[table] = {}
+        for item_id, record in records.items():
+            partitions[shard_of(item_id, shards)][table][item_id] = record
+    return partitions
+
+def write_shard(path, index, partition, previous=None, affected=None):
+    """ シャードを1つ書き出す。(シャードの情報, テーブルごとの前回からの変更) を返す
+
+    previous (前回の同じ番号のシャード) と同じ内容なら書き直さない。
+    affected は item_sections と同じ
+    """
+    writer = SnapshotWriter()
+    changes = {}
+    for table, records in partition.items():
+        old_records = None
+        if previous is not None and previous.has(table + '.key.off'):
+            old_records = previous.table(table)
+        changes[table] = writer.add_records(table, records, old_records, (affected or {}).get(table, None))
+    writer.meta['shard'] = index
+    version = writer.version()
+    if previous is None or version != previous.version:
+        if previous is not None:
+            # Windows では開いたままのファイルを置き換えられない
+            previous.close()
+        writer.write(shard_path(path, index))
+    info = {'version': version, 'size': os.path.getsize(shard_path(path, index)),
+            'counts': {table: len(records) for table, records in partition.items()}}
+    return info, changes
+
+def write_sections(path, sections, previous_version=None, shards=None):
+    """ item_sections, extra_sections で作ったセクションを順に並べて書き出す
+
+    shards (write_shard で書いたシャードの情報のリスト) があれば、その一覧も置く。
+    版が previous_version と同じなら書き直さない
+    """
+    writer = SnapshotWriter()
+    writer.sections.update(sections)
+    if shards:
+        writer.meta['shards'] = len(shards)
+        # シャードの版もディレクトリの版に含める
+        writer.add_bytes('shards', json.dumps(shards, ensure_ascii=False).encode('utf-8'))
+    if previous_version is not None and writer.version() == previous_version:
+        return previous_version
+    return writer.write(path)
+
+def write_database(path, database, previous=None, changes=None):
+    """ database.json と同じ内容をスナップショットに書き出す
+
+    previous (前回の Snapshot) があれば n-gram のポスティングはそれを直して作る。
+    changes に辞書を渡すと、前回からの変更 (名前と各レコードの増減) を入れる
+    """
+    sections = []
+    for item_type in ITEM_TYPES:
+        item_type_sections, item_type_changes = item_sections(database, item_type, previous)
+        sections.extend(item_type_sections)
+        if changes is not None and item_type_changes is not None:
+            changes[item_type] = item_type_changes
+    sections.extend(extra_sections(database))
+    previous_version = None
+    if previous is not None:
+        previous_version = previous.version
+        # Windows では開いたままのファイルを置き換えられない
+        previous.close()
+    return write_sections(path, sections, previous_version)
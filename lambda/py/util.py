@@ -5,9 +5,14 @@
 ユーティリティ
 """
 
+import json
 import logging
+from collections import OrderedDict
 import os
+import random
 import re
+import reprlib
+import sys
 import unicodedata
 
 def get_logger(name, level=None):
@@ -19,9 +24,176 @@ def get_logger(name, level=None):
         logger.setLevel(loglevel)
     return logger
 
+# DEBUG ログを出すリクエストの割合と、1つの値を出す長さの上限
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', '1.0'))
+LOG_MAX_LENGTH = int(os.environ.get('LOG_MAX_LENGTH', '2000'))
+
+def log_sampled(rate=None):
+    """ このリクエストのログを出すか。LOG_SAMPLE_RATE の確率で True """
+    rate = LOG_SAMPLE_RATE if rate is None else rate
+    return rate >= 1.0 or random.random() < rate
+
+class LogPayload:
+    """ ログに出す値。ログが出力される時になってから、上限つきの文字列にする
+
+    LOGGER.debug("... %s", LogPayload(value)) と書けば、レベルが無効な時は何もしない。
+    リストや辞書は要素数・深さを絞った repr にするので、大きさに比例した時間が掛からない
+    """
+    _repr = reprlib.Repr()
+    _repr.maxlevel = 4
+    _repr.maxdict = 20
+    _repr.maxlist = 20
+    _repr.maxstring = 200
+    _repr.maxother = 200
+
+    def __init__(self, value, max_length=None):
+        self.value = value
+        self.max_length = LOG_MAX_LENGTH if max_length is None else max_length
+
+    def __str__(self):
+        value = self.value
+        to_dict = getattr(value, 'to_dict', None)
+        if callable(to_dict):
+            # ask-sdk のモデルの __repr__ は pprint で全体をたどるので、辞書にしてから絞る
+            value = to_dict()
+        text = self._repr.repr(value)
+        if len(text) > self.max_length:
+            text = text[:self.max_length] + '...({} chars)'.format(len(text))
+        return text
+
+RE_KARAOKE = re.compile(r"(Karaoke|karaoke|KARAOKE|less vocal|カラオケ|インスト)")
+def is_karaoke(name):
+    """ カラオケ版の名前か """
+    return bool(name and RE_KARAOKE.search(name))
+
+class LazyDict(dict):
+    """ 初めて参照されたキーの値を loader(key) で作る辞書 """
+    def __init__(self, loader):
+        super().__init__()
+        self.loader = loader
+
+    def __missing__(self, key):
+        value = self.loader(key)
+        self[key] = value
+        return value
+
+class LruCache:
+    """ 件数上限つきの LRU キャッシュ。ヒット/ミスの回数を数える """
+    MISSING = object()
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """ 値を得る。無ければ default """
+        try:
+            value = self.data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """ 値を入れる。上限を超えたら最も古いものを捨てる """
+        if self.maxsize <= 0:
+            return
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def discard(self, key):
+        """ key を捨てる """
+        self.data.pop(key, None)
+
+    def clear(self):
+        """ 全て捨てる """
+        self.data.clear()
+
+    def validate(self, version):
+        """ version が前回と違えば全て捨てる """
+        if version != self.version:
+            self.data.clear()
+            self.version = version
+
+    def stats(self):
+        """ 統計を得る """
+        return {'size': len(self.data), 'hits': self.hits, 'misses': self.misses}
+
+    def __len__(self):
+        return len(self.data)
+
+class _CharTable(dict):
+    """ str.translate 用の文字変換表。初めて出てきた文字の時に変換先を決める """
+    def __init__(self, char_map):
+        super().__init__()
+        self.char_map = char_map
+
+    def __missing__(self, code):
+        char = chr(code)
+        if unicodedata.category(char)[0] not in ('L', 'N'):
+            value = None
+        else:
+            # ひらがなはカタカナへ
+            if 'ぁ' <= char <= 'ゔ':
+                char = chr(code + ord('ァ') - ord('ぁ'))
+            value = self.char_map.get(char, char) or None
+        self[code] = value
+        return value
+
+class YomiNormalizer:
+    """ かな読みの正規化器
+
+    1文字単位の変換は str.translate で、複数文字の書き換えは規則を1つに
+    まとめた正規表現で、それぞれ1回の走査で行う。規則は前にあるものほど
+    優先される
+    """
+    def __init__(self, char_map, rewrite_rules):
+        self.table = _CharTable(char_map)
+        self.pattern = re.compile('|'.join('({})'.format(rule) for rule, _ in rewrite_rules))
+        self.replacements = [replacement for _, replacement in rewrite_rules]
+
+    def _replace(self, match):
+        return self.replacements[match.lastindex - 1]
+
+    def __call__(self, s):
+        return self.pattern.sub(self._replace, s.translate(self.table))
+
+YOMI_CHAR_MAP = {'ー': '', 'ヰ': 'イ', 'ヱ': 'エ', 'ヂ': 'ジ', 'ヅ': 'ズ', 'ヮ': 'ア'}
+YOMI_REWRITE_RULES = [
+    ('[ツテ]ィ', 'チ'),
+    ('ク[サシスソ]', 'キ'),
+    ('ヴ[ァア]', 'バ'),
+    ('ヴ[ィイ]', 'ビ'),
+    ('ヴ[ェエ]', 'ベ'),
+    ('ヴ[ォオ]', 'ボ'),
+    ('ファ', 'ハ'),
+    ('フィ', 'ヒ'),
+    ('フェ', 'ヘ'),
+    ('フォ', 'ホ'),
+    ('グァ', 'ガ'),
+    ('シェ', 'セ'),
+    ('ジェ', 'ゼ'),
+    ('トゥ', 'ト'),
+    ('ツ', 'ト'),
+    ('ドゥ', 'ド'),
+    ('デュ', 'ジュ'),
+    ('テュ', 'チュ'),
+    ('イェ', 'エ'),
+    ('ッ', ''),
+]
+
+yomi_normalize = YomiNormalizer(YOMI_CHAR_MAP, YOMI_REWRITE_RULES)
+
 RE_HIRAGANA = re.compile(r'[ぁ-ゔ]')
-def yomi_normalize(s):
-    """ かな読みの正規化を行う """
+def yomi_normalize_reference(s):
+    """ かな読みの正規化 (規則を1つずつ適用する版。yomi_normalize の検証用) """
     s = ''.join([i for i in list(s) if re.match(r"^(L|N)", unicodedata.category(i)[0])])
     s = RE_HIRAGANA.sub(lambda x: chr(ord(x.group(0)) + ord('ァ') - ord('ぁ')), s)
     s = re.sub(r'ー', r'', s)
@@ -51,3 +223,26 @@ def yomi_normalize(s):
     s = re.sub(r'イェ', r'エ', s)
     s = re.sub(r'ッ', r'', s)
     return s
+
+def module_test():
+    """ yomi_normalize と yomi_normalize_reference の結果を database.json の全キーで比較する """
+    path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(__file__), 'data', 'database.json')
+    with open(path, 'rt', encoding='utf-8') as file_pointer:
+        data_base = json.load(file_pointer)
+    names = set()
+    for item_type in ['artist', 'album', 'title']:
+        names.update(data_base[item_type].keys())
+    for title in data_base['music']['title'].values():
+        names.update([title['title'], title['artist']])
+    mismatch = 0
+    for name in sorted(names):
+        expected = yomi_normalize_reference(name)
+        actual = yomi_normalize(name)
+        if expected != actual:
+            mismatch += 1
+            print('{}\t{}\t{}'.format(name, expected, actual))
+    print('{} names, {} mismatches'.format(len(names), mismatch))
+    return mismatch == 0
+
+if __name__ == '__main__':
+    sys.exit(0 if module_test() else 1)
@@ -2,9 +2,15 @@
 
 #python musicdb/musiclist2json.py -l musicdb/iTunes_list.txt -o musicdb/words.json --path_parser posix
 # words.json を加工して、カタカナ読みテーブル translate.json を用意する
-python musicdb/musiclist2json.py -l musicdb/iTunes_list.txt -d musicdb/translate.json -o musicdb/list.json --path_parser posix
+# 前回から曲が変わっていなければ list.json はそのまま
+# translate.json に無い単語は uncovered.json に出るので、読みを足していく
+python musicdb/musiclist2json.py -l musicdb/iTunes_list.txt -d musicdb/translate.json -o musicdb/list.json --path_parser posix --manifest musicdb/manifest.json --uncovered musicdb/uncovered.json
 if [ ! -d lambda/py/data ]; then
     mkdir lambda/py/data
 fi
-python makelanguagemodel.py -i musicdb/list.json -o models/ja-JP.json -s "おうちサーバー" -d lambda/py/data/database.json --pickle lambda/py/data/simstring.db
-python makelanguagemodel.py -i musicdb/list.json -o models/ja-JP-debug.json -s "おうちサーバー" -d lambda/py/data/database-debug.json --debug
+# 前回のビルドの記録 (build-manifest.json) と比べて、変わったアルバムのレコード・ポスティングだけを作り直す
+# (読みの辞書と models/ja-JP.json・database.json は毎回全体を作り直し、内容が同じならファイルを置き換えない)
+# MUSIC_URL_BASE・MUSICDB_SHARDS を変えた時や、出力が消えたり書き換えられたりした時は全部作り直す
+# MUSICDB_SHARDS を決めると、レコードをその数のファイルに分けて実行時のメモリを抑える (既にあるツリーでも次の make.sh で分け直す)
+# デバッグ用の整形した出力も、同じ解析結果から1回で書く。出力ごとに CPU の数までのプロセスで並列に作る
+python makelanguagemodel.py -i musicdb/list.json -o models/ja-JP.json -s "おうちサーバー" -d lambda/py/data/database.json --pickle lambda/py/data/ngram.db --snapshot lambda/py/data/database.snap ${MUSIC_URL_BASE:+--url_base "$MUSIC_URL_BASE"} ${MUSICDB_SHARDS:+--shards "$MUSICDB_SHARDS"} --incremental --changelog musicdb/changelog.json --manifest musicdb/build-manifest.json --debug_output models/ja-JP-debug.json --debug_database lambda/py/data/database-debug.json
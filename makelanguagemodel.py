@@ -5,22 +5,40 @@
 楽曲データのJSONから、Alexaのmodelとスキル用のデータベースを生成します
 """
 
-import re
-import unicodedata
+import os
+import sys
 import argparse
+import filecmp
+import functools
+import hashlib
+import itertools
 import json
+import multiprocessing
 import pickle
-from collections import defaultdict
-from simstring.feature_extractor.character_ngram import CharacterNgramFeatureExtractor
-from simstring.database.dict import DictDatabase
+from collections import OrderedDict, defaultdict
+from urllib.parse import urljoin
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lambda', 'py'))
+import ngram
+import snapshot
+import util
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-s", "--skill", help="skill invocationName", type=str)
 parser.add_argument("-i", "--input", help="music json file", type=str)
 parser.add_argument("-o", "--output", help="output languageModel json file", type=str)
 parser.add_argument("-d", "--database", help="output database for skill json file", type=str)
-parser.add_argument("-p", "--pickle", help="output for SimString pickled database", type=str)
+parser.add_argument("-p", "--pickle", help="output for pickled n-gram index", type=str)
+parser.add_argument("--snapshot", help="output database snapshot for skill", type=str)
+parser.add_argument("--shards", help="split records of the snapshot into this number of files", type=int, default=0)
+parser.add_argument("--url_base", help="MUSIC_URL_BASE of the skill, to resolve stream urls in advance", type=str)
+parser.add_argument("--incremental", help="reuse the previous snapshot and keep unchanged outputs", action='store_true')
+parser.add_argument("--manifest", help="build manifest. with --incremental, skip an unchanged input, or rebuild only the snapshot records and n-gram postings that changed since the recorded build", type=str)
+parser.add_argument("--changelog", help="output changes from the previous snapshot as json", type=str)
 parser.add_argument("--debug", help="for debug", action='count')
+parser.add_argument("--debug_output", help="also output indented languageModel json file", type=str)
+parser.add_argument("--debug_database", help="also output indented database json file", type=str)
+parser.add_argument("-j", "--jobs", help="number of processes", type=int, default=os.cpu_count() or 1)
 args = parser.parse_args()
 
 
@@ -203,41 +221,141 @@ if (not args.input) or (not args.output) or (not args.skill):
     exit(1)
 MY_NAME = args.skill
 
-with open(args.input, encoding='utf-8') as f:
-    mdb = json.load(f)
-
-re_hiragana = re.compile(r'[ぁ-ゔ]')
-def yomi_normalize(s):
-    """ かな読みの正規化を行う """
-    s = ''.join([i for i in list(s) if re.match(r"^(L|N)", unicodedata.category(i)[0])])
-    s = re_hiragana.sub(lambda x: chr(ord(x.group(0)) + ord('ァ') - ord('ぁ')), s)
-    s = re.sub(r'ー', r'', s)
-    s = re.sub(r'ヰ', r'イ', s)
-    s = re.sub(r'ヱ', r'エ', s)
-    s = re.sub(r'ヂ', r'ジ', s)
-    s = re.sub(r'ヅ', r'ズ', s)
-    s = re.sub(r'ヮ', r'ア', s)
-    s = re.sub(r'(ツ|テ)ィ', r'チ', s)
-    s = re.sub(r'ク(サ|シ|ス|ソ)', r'キ\1', s)
-    s = re.sub(r'ヴ(ァ|ア)', r'バ', s)
-    s = re.sub(r'ヴ(ィ|イ)', r'ビ', s)
-    s = re.sub(r'ヴ(ェ|エ)', r'ベ', s)
-    s = re.sub(r'ヴ(ォ|オ)', r'ボ', s)
-    s = re.sub(r'ファ', r'ハ', s)
-    s = re.sub(r'フィ', r'ヒ', s)
-    s = re.sub(r'フェ', r'ヘ', s)
-    s = re.sub(r'フォ', r'ホ', s)
-    s = re.sub(r'グァ', r'ガ', s)
-    s = re.sub(r'シェ', r'セ', s)
-    s = re.sub(r'ジェ', r'ゼ', s)
-    s = re.sub(r'トゥ', r'ト', s)
-    s = re.sub(r'ツ', r'ト', s)
-    s = re.sub(r'ドゥ', r'ド', s)
-    s = re.sub(r'デュ', r'ジュ', s)
-    s = re.sub(r'テュ', r'チュ', s)
-    s = re.sub(r'イェ', r'エ', s)
-    s = re.sub(r'ッ', r'', s)
-    return s
+# manifest の形式。出力の作り方を変えたら上げて、前回のビルドを使わない様にする
+BUILD_MANIFEST_FORMAT = 1
+
+def digest(data):
+    """ 変更を調べる為のダイジェスト """
+    return hashlib.sha1(data).hexdigest()[:16]
+
+def output_paths():
+    """ 書き出すファイルのパス """
+    return [path for path in [args.output, args.database, args.pickle, args.snapshot,
+                              args.debug_output, args.debug_database] if path]
+
+def file_stats(paths):
+    """ パス -> [大きさ, 更新時刻]。無いファイルは含めない """
+    stats = {}
+    for path in paths:
+        if os.path.exists(path):
+            stat = os.stat(path)
+            stats[path] = [stat.st_size, stat.st_mtime_ns]
+    return stats
+
+def read_manifest(path):
+    """ 前回のビルドの manifest を読む。無ければ空 """
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def rebuild_reason(manifest, options):
+    """ 前回のビルドを元にできない理由。できるなら None
+
+    設定が同じで、出力 (シャードを含む) が前回書いたまま残っている時だけ元にする
+    """
+    if not manifest:
+        return 'no manifest'
+    if manifest.get('format') != BUILD_MANIFEST_FORMAT or manifest.get('options') != options:
+        return 'options changed'
+    outputs = manifest.get('outputs', {})
+    paths = output_paths()
+    if args.snapshot:
+        paths += [snapshot.shard_path(args.snapshot, index) for index in range(args.shards)]
+    stats = file_stats(paths)
+    for path in paths:
+        if path not in outputs or stats.get(path, None) != outputs[path]:
+            return 'output missing or modified: {}'.format(path)
+    return None
+
+with open(args.input, 'rb') as f:
+    input_data = f.read()
+input_digest = digest(input_data)
+# 出力の内容を変える設定。変わったら前回のビルドは使えない
+build_options = {'skill': args.skill, 'url_base': args.url_base, 'shards': args.shards, 'debug': args.debug}
+build_manifest = {}
+if args.manifest and args.incremental:
+    build_manifest = read_manifest(args.manifest)
+    reason = rebuild_reason(build_manifest, build_options)
+    if reason is None and build_manifest['input'] == input_digest:
+        print('no changes: {}'.format(args.input))
+        if args.changelog:
+            with open(args.changelog, 'wt', encoding='utf-8', newline='\n') as f:
+                json.dump({'model_changed': False, 'previous_version': build_manifest['version'],
+                           'version': build_manifest['version']}, f, ensure_ascii=False, indent=4)
+        exit(0)
+    if reason is not None:
+        print('full build: {}'.format(reason))
+        build_manifest = {}
+
+mdb = json.loads(input_data)
+del input_data
+
+# 実行時の util.yomi_normalize と違い、ク(サ|シ|ス|ソ) は後ろの文字を残してキにする
+YOMI_REWRITE_RULES = [('ク(?=[サシスソ])', 'キ') if rule == 'ク[サシスソ]' else (rule, replacement)
+                      for rule, replacement in util.YOMI_REWRITE_RULES]
+# 同じ名前・読みが何度も出てくるので結果を覚えておく
+yomi_normalize = functools.lru_cache(maxsize=None)(util.YomiNormalizer(util.YOMI_CHAR_MAP, YOMI_REWRITE_RULES))
+
+JSON_ENCODER = json.JSONEncoder(ensure_ascii=False)
+
+def write_json(f, data, depth=4, chunk_size=1000):
+    """ json.dump(data, f, ensure_ascii=False, sort_keys=False) と同じものを書く
+
+    json.dump は要素ごとに Python の encoder で書くので遅い。
+    大きな辞書・リストは chunk_size 要素ずつ、小さなものは depth 段目まで
+    要素ごとに C の encoder で書き、全体を1つの文字列にはしない
+    """
+    if isinstance(data, (dict, list)) and len(data) > chunk_size:
+        is_dict = isinstance(data, dict)
+        items = iter(data.items() if is_dict else data)
+        f.write('{' if is_dict else '[')
+        for i, chunk in enumerate(iter(lambda: list(itertools.islice(items, chunk_size)), [])):
+            if i:
+                f.write(', ')
+            f.write(JSON_ENCODER.encode(dict(chunk) if is_dict else chunk)[1:-1])
+        f.write('}' if is_dict else ']')
+    elif depth and isinstance(data, dict):
+        f.write('{')
+        for i, (key, value) in enumerate(data.items()):
+            if i:
+                f.write(', ')
+            f.write(JSON_ENCODER.encode(key))
+            f.write(': ')
+            write_json(f, value, depth - 1, chunk_size)
+        f.write('}')
+    elif depth and isinstance(data, list):
+        f.write('[')
+        for i, value in enumerate(data):
+            if i:
+                f.write(', ')
+            write_json(f, value, depth - 1, chunk_size)
+        f.write(']')
+    else:
+        f.write(JSON_ENCODER.encode(data))
+
+class OutputFile:
+    """ 出力ファイル。incremental の時は別名に書いて、内容が変わった時だけ置き換える """
+    def __init__(self, path, incremental):
+        self.path = path
+        self.incremental = incremental
+        self.temp_path = path + '.tmp' if incremental else path
+        self.file_pointer = None
+        self.changed = True
+
+    def __enter__(self):
+        self.file_pointer = open(self.temp_path, 'wt', encoding='utf-8', newline='\n')
+        return self.file_pointer
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.file_pointer.close()
+        if self.incremental:
+            if exc_type is None and os.path.exists(self.path) and filecmp.cmp(self.temp_path, self.path, shallow=False):
+                self.changed = False
+                os.remove(self.temp_path)
+            elif exc_type is None:
+                os.replace(self.temp_path, self.path)
+        return False
 
 artistdict = mdb['artist']
 albumdict = mdb['album']
@@ -254,42 +372,84 @@ titleYomiDict = {}
 for i, d, y in zip([artistid, albumid, titleid],
                    [artistdict, albumdict, titledict],
                    [artistYomiDict, albumYomiDict, titleYomiDict]):
+    # id -> synonyms に入っている名前 (リストの in は別名の多い id で遅いので set で調べる)
+    synonym_sets = {}
     for name, v in d.items():
         item_id = v['id']
-        idarr = item_id.split("/")
+        first_id = item_id.split("/", 1)[0]
         for pri, k in enumerate([name, v['yomi'], yomi_normalize(name), yomi_normalize(v['yomi'])]):
-            for j in idarr:
-                if not k in y:
-                    # 最小プライオリティのものだけ書けば良い
-                    y[k] = {'id': j, 'priority': pri}
+            if k not in y:
+                # 最小プライオリティのものだけ書けば良い
+                y[k] = {'id': first_id, 'priority': pri}
         if len(item_id) > 100:
-            item_id = idarr[0]
+            item_id = first_id
         yomi = v['yomi'][:140]
         name = name[:140]
-        if item_id in i:
-            if not 'synonyms' in i[item_id]['name']:
-                i[item_id]['name']['synonyms'] = []
-            if not name in i[item_id]['name']['synonyms']:
-                i[item_id]['name']['synonyms'].append(name)
-            if name != yomi:
-                i[item_id]['name']['synonyms'].append(yomi)
+        entry = i.get(item_id)
+        if entry is None:
+            entry = i[item_id] = {'id': item_id, 'name': {'value': name}}
+            synonym_set = synonym_sets[item_id] = set()
         else:
-            i[item_id] = {'id': item_id, 'name': {'value': name}}
-            if name != yomi:
-                if 'synonyms' in i[item_id]['name']:
-                    i[item_id]['name']['synonyms'].append(yomi)
-                else:
-                    i[item_id]['name']['synonyms'] = [yomi]
+            synonym_set = synonym_sets[item_id]
+            if name not in synonym_set:
+                entry['name'].setdefault('synonyms', []).append(name)
+                synonym_set.add(name)
+        if name != yomi:
+            # 読みは重複していても足す (これまでの出力と同じにする)
+            entry['name'].setdefault('synonyms', []).append(yomi)
+            synonym_set.add(yomi)
 
 model = create_model()
 
-with open(args.output, 'wt', encoding='utf-8', newline='\n') as f:
-    if args.debug:
-        json.dump(model, f, ensure_ascii=False, sort_keys=False, indent=4)
-    else:
-        json.dump(model, f, ensure_ascii=False, sort_keys=False)
+def album_digests():
+    """ list.json のアルバムごとの [ダイジェスト, アルバムID, アルバムアーティストID, [[曲ID, アーティストID], ...]]
 
-if args.database:
+    キーはアルバムアーティストとアルバムの名前。曲の読みもダイジェストに含める
+    """
+    albums = {}
+    for albumartist, artist in mdb['music'].items():
+        for album_name, album in artist['album'].items():
+            yomis = [titledict.get(name, {}).get('yomi', name) for name in album['title']]
+            albums[albumartist + '\t' + album_name] = [
+                digest(JSON_ENCODER.encode([album, yomis]).encode('utf-8')),
+                album['id'], album['albumartist_id'],
+                [[title['id'], title['artist_id']] for title in album['title'].values()]]
+    return albums
+
+def affected_records(old_albums, albums, old_names, names):
+    """ 前回のビルドから変わったかもしれないレコードの ID。テーブル名 -> ID の集合
+
+    変わったアルバムの前後の曲・アルバム・アーティストと、名前が変わったアーティスト・アルバム。
+    それ以外のレコードの内容は、入力の同じ部分だけで決まるので前回と同じになる
+    """
+    ids = {'artist': set(), 'album': set(), 'title': set()}
+    for key in old_albums.keys() | albums.keys():
+        old_album = old_albums.get(key, None)
+        album = albums.get(key, None)
+        if old_album is not None and album is not None and old_album[0] == album[0]:
+            continue
+        for entry in [old_album, album]:
+            if entry is not None:
+                _, album_id, albumartist_id, titles = entry
+                ids['album'].add(album_id)
+                ids['artist'].add(albumartist_id)
+                for title_id, artist_id in titles:
+                    ids['title'].add(title_id)
+                    ids['artist'].add(artist_id)
+    for item_type in ['artist', 'album']:
+        old_item_names = old_names[item_type]
+        ids[item_type].update(item_id for item_id, name_digest in names[item_type].items()
+                              if old_item_names.get(item_id, None) != name_digest)
+    return {'music.artist': ids['artist'], 'music.album': ids['album'], 'music.title': ids['title'],
+            'artist_title': ids['artist']}
+
+# 前回のビルドから変わったかもしれないレコード。None なら全て作り直す
+affected = None
+albums_state = album_digests() if args.manifest else None
+names_state = None
+
+output = None
+if args.database or args.debug_database or args.snapshot:
     # idからインデックスする辞書として、musicdbを作る
     musicdb = {'artist': defaultdict(lambda: {'name':'', 'album': set(), 'title': set()}),
                'album': defaultdict(lambda: {'name': '', 'title': set()}),
@@ -305,40 +465,216 @@ if args.database:
             for name, title in album['title'].items():
                 musicdb['title'][title['id']] = title
                 musicdb['title'][title['id']]['title'] = name
+                if args.url_base:
+                    musicdb['title'][title['id']]['url'] = urljoin(args.url_base, title['path'])
                 musicdb['artist'][title['artist_id']]['title'].add(title['id'])
                 if 'album_id' in title:
                     musicdb['album'][title['album_id']]['title'].add(title['id'])
     # listに詰め直し
     for entry in musicdb['artist'].values():
-        entry['album'] = list(entry['album'])
-        entry['title'] = list(entry['title'])
+        # シャッフルの seed から同じ順序を作り直せる様に、ビルド毎に順序を固定する
+        entry['album'] = sorted(entry['album'])
+        entry['title'] = sorted(entry['title'])
     for entry in musicdb['album'].values():
-        sort_temp = sorted(entry['title'], key=lambda id: musicdb['title'][id]['track'])
+        # ディスク・トラック番号が同じ曲は ID 順にして、set の順序 (ハッシュ) によらない様にする
+        sort_temp = sorted(sorted(entry['title']), key=lambda id: musicdb['title'][id]['track'])
         entry['title'] = sorted(sort_temp, key=lambda id: musicdb['title'][id]['disc'])
+    # カラオケを除いた再生対象リスト
+    for entry in itertools.chain(musicdb['artist'].values(), musicdb['album'].values()):
+        entry['playable'] = [id for id in entry['title'] if not musicdb['title'][id]['karaoke']]
+
+    if args.manifest:
+        # アーティスト・アルバムのレコードの名前 (別名を含む) は、名前の辞書全体で決まる
+        names_state = {item_type: {item_id: digest(JSON_ENCODER.encode(entry['name']).encode('utf-8'))
+                                   for item_id, entry in musicdb[item_type].items()}
+                       for item_type in ['artist', 'album']}
+        if build_manifest and args.snapshot:
+            affected = affected_records(build_manifest['albums'], albums_state,
+                                        build_manifest['names'], names_state)
+
+    # アーティストごとの曲名辞書 (artist_id -> 読み -> [[title_id, priority], ...])
+    artist_title = {}
+    previous_artist_title = {}
+    if affected is not None:
+        # 変わっていないアーティストは前回のものを使う
+        previous_artist_title = snapshot.read_records(
+            args.snapshot, 'artist_title',
+            {title['artist_id'] for title in musicdb['title'].values()} - affected['artist_title'])
+    for title_id, title in musicdb['title'].items():
+        if title['artist_id'] in previous_artist_title:
+            artist_title.setdefault(title['artist_id'], previous_artist_title[title['artist_id']])
+            continue
+        name = title['title']
+        yomi = titledict.get(name, {}).get('yomi', name)
+        title_keys = artist_title.setdefault(title['artist_id'], {})
+        # 同じ曲が複数のプライオリティで入らない様に、曲ごとに最小のものだけ入れる
+        best = {}
+        for pri, k in enumerate([name, yomi, yomi_normalize(name), yomi_normalize(yomi)]):
+            best.setdefault(k, pri)
+        for k, pri in best.items():
+            title_keys.setdefault(k, []).append([title_id, pri])
+    for artist_id, title_keys in artist_title.items():
+        if artist_id in previous_artist_title:
+            continue
+        for entries in title_keys.values():
+            # プライオリティ順に並べる
+            if len(entries) > 1:
+                entries.sort(key=lambda e: e[1])
 
     # json出力
     output = {'artist': artistYomiDict,
               'album': albumYomiDict,
               'title': titleYomiDict,
-              'music': musicdb}
-    with open(args.database, 'wt', encoding='utf-8', newline='\n') as f:
-        if args.debug:
-            json.dump(output, f, ensure_ascii=False, sort_keys=False, indent=4)
+              'music': musicdb,
+              'artist_title': artist_title}
+    if args.url_base:
+        # 実行時の MUSIC_URL_BASE と同じ時だけ title の url を使う
+        output['meta'] = {'url_base': args.url_base}
+
+def write_json_file(data_name, path, debug):
+    """ model か output を json に書く。内容が変わったかを返す """
+    data = model if data_name == 'model' else output
+    output_file = OutputFile(path, args.incremental)
+    with output_file as f:
+        if debug:
+            json.dump(data, f, ensure_ascii=False, sort_keys=False, indent=4)
         else:
-            json.dump(output, f, ensure_ascii=False, sort_keys=False)
-
-    # SimString 辞書
-    if args.pickle:
-        with open(args.pickle, "wb") as fw_simstring:
-            artist_db = DictDatabase(CharacterNgramFeatureExtractor(2))
-            for yomi in artistYomiDict.keys():
-                artist_db.add(yomi)
-            album_db = DictDatabase(CharacterNgramFeatureExtractor(2))
-            for yomi in albumYomiDict.keys():
-                album_db.add(yomi)
-            title_db = DictDatabase(CharacterNgramFeatureExtractor(2))
-            for yomi in titleYomiDict.keys():
-                title_db.add(yomi)
-            simstring_dict = { 'artist': artist_db, 'album': album_db, 'title': title_db}
-            pickle.dump(simstring_dict, fw_simstring, pickle.HIGHEST_PROTOCOL)
+            write_json(f, data)
+    return output_file.changed
+
+def build_snapshot_sections(item_type, previous_path):
+    """ スナップショットの item_type の分のセクションと、前回からの変更を作る """
+    previous = snapshot.Snapshot(previous_path) if previous_path else None
+    try:
+        return snapshot.item_sections(output, item_type, previous, records=not args.shards, affected=affected)
+    finally:
+        if previous is not None:
+            previous.close()
+
+def build_extra_sections(previous_path):
+    """ スナップショットの種類によらないセクションを作る """
+    previous = snapshot.Snapshot(previous_path) if previous_path else None
+    try:
+        return snapshot.extra_sections(output, records=not args.shards, previous=previous, affected=affected)
+    finally:
+        if previous is not None:
+            previous.close()
+
+def write_snapshot_shard(index, previous_path):
+    """ スナップショットのシャードを書く """
+    previous = snapshot.Snapshot(previous_path) if previous_path else None
+    try:
+        return snapshot.write_shard(args.snapshot, index, partitions[index], previous, affected)
+    finally:
+        if previous is not None:
+            previous.close()
+
+def write_ngram_pickle(path, previous_path):
+    """ n-gram 類似検索の索引を pickle で書く。previous_path (前回の pickle) があれば、その索引を直して作る """
+    previous = {}
+    if previous_path:
+        with open(previous_path, "rb") as f_ngram:
+            previous = pickle.load(f_ngram)
+    ngram_dict = {item_type: ngram.NgramIndex(yomi_dict.keys(), previous=previous.get(item_type, None))
+                  for item_type, yomi_dict in [('artist', artistYomiDict),
+                                               ('album', albumYomiDict),
+                                               ('title', titleYomiDict)]}
+    with open(path, "wb") as fw_ngram:
+        pickle.dump(ngram_dict, fw_ngram, pickle.HIGHEST_PROTOCOL)
+
+def run_tasks(tasks, jobs):
+    """ 名前 -> (関数, 引数) の辞書を実行して、名前 -> 結果 の辞書を返す
+
+    fork できる環境ではプロセスプールで並列に動かす。子プロセスは model, output を
+    fork 時のメモリのまま共有するので、引数と結果だけを受け渡す
+    """
+    if jobs > 1 and len(tasks) > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        with multiprocessing.get_context('fork').Pool(min(jobs, len(tasks))) as pool:
+            results = {name: pool.apply_async(task, task_args) for name, (task, task_args) in tasks.items()}
+            return {name: result.get() for name, result in results.items()}
+    return {name: task(*task_args) for name, (task, task_args) in tasks.items()}
+
+changelog = {}
+previous_version = None
+previous_path = None
+previous_shards = 0
+if args.snapshot and args.incremental and os.path.exists(args.snapshot) and (build_manifest or not args.manifest):
+    try:
+        previous = snapshot.Snapshot(args.snapshot)
+        previous_version = previous.version
+        previous_path = args.snapshot
+        previous_shards = len(previous.shards())
+        previous.close()
+    except snapshot.SnapshotError as e:
+        print('rebuild snapshot: {}'.format(e))
+# レコードをシャードに分ける (子プロセスは fork 時のものを使う)
+partitions = snapshot.partition_records(output, args.shards) if args.snapshot and args.shards else []
+
+# 時間のかかるものから順に並べる
+tasks = OrderedDict()
+if args.snapshot:
+    # スナップショット (読み込み時のパースを省いた形式)。前回の n-gram を直して使う
+    for item_type in reversed(snapshot.ITEM_TYPES):
+        tasks['snapshot.' + item_type] = (build_snapshot_sections, (item_type, previous_path))
+    tasks['snapshot'] = (build_extra_sections, (previous_path,))
+    for index in range(len(partitions)):
+        # シャードの数が前回と同じ時だけ、前回の同じ番号のシャードと比べる
+        previous_shard_path = snapshot.shard_path(args.snapshot, index) if previous_shards == len(partitions) else None
+        tasks['shard.{}'.format(index)] = (write_snapshot_shard, (index, previous_shard_path))
+if args.database:
+    tasks['database'] = (write_json_file, ('output', args.database, args.debug))
+if args.debug_database:
+    tasks['debug_database'] = (write_json_file, ('output', args.debug_database, True))
+if args.pickle and output is not None:
+    # 前回のビルドのまま残っている時だけ元にする
+    tasks['pickle'] = (write_ngram_pickle, (args.pickle, args.pickle if build_manifest else None))
+tasks['model'] = (write_json_file, ('model', args.output, args.debug))
+if args.debug_output:
+    tasks['debug_model'] = (write_json_file, ('model', args.debug_output, True))
+results = run_tasks(tasks, args.jobs)
+
+changelog['model_changed'] = results['model']
+if args.database:
+    changelog['database_changed'] = results['database']
+if args.snapshot:
+    sections = []
+    shard_results = [results['shard.{}'.format(index)] for index in range(len(partitions))]
+    for item_type in snapshot.ITEM_TYPES:
+        item_type_sections, item_type_changes = results['snapshot.' + item_type]
+        sections.extend(item_type_sections)
+        shard_changes = [changes['music.' + item_type] for _, changes in shard_results]
+        if shard_results and item_type_changes is not None and None not in shard_changes:
+            # シャードごとのレコードの変更をまとめる
+            record_changes = {key: sorted(itertools.chain.from_iterable(changes[key] for changes in shard_changes))
+                              for key in ['added', 'removed', 'changed']}
+            item_type_changes = dict(record_changes, **item_type_changes)
+        if item_type_changes is not None:
+            changelog[item_type] = item_type_changes
+    sections.extend(results['snapshot'])
+    if previous_version is not None:
+        changelog['previous_version'] = previous_version
+    else:
+        changelog['full_rebuild'] = True
+    changelog['version'] = snapshot.write_sections(args.snapshot, sections, previous_version,
+                                                   [info for info, _ in shard_results])
+    # シャードの数を減らした時の残りを消す
+    index = len(partitions)
+    while os.path.exists(snapshot.shard_path(args.snapshot, index)):
+        os.remove(snapshot.shard_path(args.snapshot, index))
+        index += 1
+
+if args.changelog:
+    with open(args.changelog, 'wt', encoding='utf-8', newline='\n') as f:
+        json.dump(changelog, f, ensure_ascii=False, sort_keys=False, indent=4)
 
+if args.manifest:
+    # 次の --incremental で使う。出力を全て書き終えてから置き換える
+    outputs = output_paths()
+    if args.snapshot:
+        outputs += [snapshot.shard_path(args.snapshot, index) for index in range(len(partitions))]
+    with open(args.manifest + '.tmp', 'wt', encoding='utf-8', newline='\n') as f:
+        # アルバムごとのダイジェストで大きいので、json.dump ではなく write_json で書く
+        write_json(f, {'format': BUILD_MANIFEST_FORMAT, 'input': input_digest, 'options': build_options,
+                       'version': changelog.get('version', None), 'outputs': file_stats(outputs),
+                       'albums': albums_state, 'names': names_state})
+    os.replace(args.manifest + '.tmp', args.manifest)
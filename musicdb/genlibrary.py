@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+"""
+規模の試験用に、beets の出力 (musiclist2json.py の入力) と同じ形式の
+架空のライブラリを作る
+
+- 日本語 (かな・カナ・漢字) と英語の混じった名前
+- コンピレーション (アルバムアーティストと曲のアーティストが違う) と feat. の共演
+- MusicBrainz ID のあるもの・無いもの
+- カラオケ・インスト版
+- 複数ディスク、ディスク-トラック番号のファイル名
+"""
+
+import argparse
+import json
+import random
+import uuid
+
+KANA = ('アイウエオカキクケコサシスセソタチツテトナニヌネノハヒフヘホマミムメモヤユヨラリルレロワン'
+        'ガギグゲゴザジズゼゾダヂヅデドバビブベボパピプペポ')
+HIRAGANA = 'あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほまみむめもやゆよらりるれろわん'
+KANJI = '愛夢空海風花雪月星光夜朝恋心君僕街道雨虹春夏秋冬歌声涙旅約束永遠青赤白黒'
+ENGLISH = ['Love', 'Song', 'Night', 'Dream', 'Blue', 'Sky', 'Heart', 'Star', 'Light', 'Rain',
+           'Summer', 'Winter', 'Road', 'Time', 'World', 'Girl', 'Boy', 'Dance', 'Fire', 'Moon',
+           'Sweet', 'Memories', 'Forever', 'Tokyo', 'City', 'Pop', 'Magic', 'Happy', 'Days', 'Wish']
+FAMILY_NAMES = ['山下', '竹内', '松任谷', '中島', '吉田', '井上', '宇多田', '椎名', '米津', '星野']
+GIVEN_NAMES = ['達郎', 'まりや', '由実', 'みゆき', '美奈子', '陽水', 'ヒカル', '林檎', '玄師', '源']
+KARAOKE_SUFFIXES = [' (オリジナル・カラオケ)', ' (Instrumental)', ' (カラオケ)', ' -less vocal-', ' (インスト)']
+COMPILATION_ARTIST = 'Various Artists'
+
+def kana_word(rand, low=2, high=6):
+    """ カタカナの単語 """
+    return ''.join(rand.choice(KANA) for _ in range(rand.randint(low, high)))
+
+def japanese_phrase(rand):
+    """ かな・漢字の句 """
+    return (''.join(rand.choice(KANJI) for _ in range(rand.randint(1, 3)))
+            + rand.choice(['の', 'と', 'に', 'を', ''])
+            + ''.join(rand.choice(HIRAGANA) for _ in range(rand.randint(0, 4))))
+
+def english_phrase(rand, low=1, high=3):
+    """ 英語の句 """
+    return ' '.join(rand.choice(ENGLISH) for _ in range(rand.randint(low, high)))
+
+def artist_name(rand, serial):
+    """ アーティスト名。serial で重複を避ける """
+    style = rand.random()
+    if style < 0.3:
+        name = rand.choice(FAMILY_NAMES) + rand.choice(GIVEN_NAMES)
+    elif style < 0.6:
+        name = kana_word(rand, 3, 7)
+    elif style < 0.85:
+        name = 'The ' + english_phrase(rand, 1, 2) + 's'
+    else:
+        name = english_phrase(rand, 1, 1) + ' ' + kana_word(rand, 2, 4)
+    return '{} {}'.format(name, serial) if serial else name
+
+def title_name(rand):
+    """ 曲名・アルバム名 """
+    style = rand.random()
+    if style < 0.35:
+        return japanese_phrase(rand)
+    if style < 0.6:
+        return kana_word(rand)
+    if style < 0.8:
+        return english_phrase(rand)
+    # 日英混じり
+    return '{} {}'.format(english_phrase(rand, 1, 2), rand.choice([japanese_phrase(rand), kana_word(rand)]))
+
+def musicbrainz_id(rand, rate):
+    """ rate の確率で MusicBrainz 風の ID。無ければ空 """
+    if rand.random() < rate:
+        return str(uuid.UUID(int=rand.getrandbits(128)))
+    return ''
+
+def generate(rand, num_titles, mbid_rate=0.6, karaoke_rate=0.05, compilation_rate=0.1, feat_rate=0.05):
+    """ beets 形式の行を num_titles 行まで順に作る """
+    artists = []
+    count = 0
+    while count < num_titles:
+        # アーティストは 1〜数十曲。後から作るアーティストほど名前の重複を避ける番号がつきやすい
+        serial = len(artists) // 500
+        artist = (artist_name(rand, serial), musicbrainz_id(rand, mbid_rate))
+        artists.append(artist)
+        compilation = rand.random() < compilation_rate and len(artists) > 10
+        albumartist = (COMPILATION_ARTIST, '89ad4ac3-39f7-470e-963a-56509c546377') if compilation else artist
+        for _ in range(rand.randint(1, 4)):
+            album = title_name(rand)
+            album_id = musicbrainz_id(rand, mbid_rate)
+            discs = 1 if rand.random() < 0.85 else rand.randint(2, 3)
+            for disc in range(1, discs + 1):
+                for track in range(1, rand.randint(6, 16) + 1):
+                    track_artist = rand.choice(artists) if compilation else artist
+                    title = title_name(rand)
+                    if rand.random() < feat_rate:
+                        title += ' (feat. {})'.format(rand.choice(artists)[0])
+                    variants = [title]
+                    if rand.random() < karaoke_rate:
+                        variants.append(title + rand.choice(KARAOKE_SUFFIXES))
+                    for variant in variants:
+                        if discs > 1:
+                            file_name = '{}-{:02d} {}.m4a'.format(disc, track, variant)
+                        else:
+                            file_name = '{:02d} {}.m4a'.format(track, variant)
+                        path = '/Users/user/Music/iTunes/iTunes Media/Music/{}/{}/{}'.format(
+                            albumartist[0], album, file_name)
+                        yield '\t'.join([path, albumartist[0], album, track_artist[0], str(disc), str(track),
+                                         variant, albumartist[1], album_id, track_artist[1],
+                                         musicbrainz_id(rand, mbid_rate)])
+                        count += 1
+                        if count >= num_titles:
+                            return
+
+def main():
+    """ main """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--titles", help="number of titles", type=int, default=10000)
+    parser.add_argument("-o", "--output", help="output beets format list", type=str, required=True)
+    parser.add_argument("-d", "--dict", help="output word to kana dictionary json", type=str)
+    parser.add_argument("--mbid_rate", help="rate of entries with MusicBrainz id", type=float, default=0.6)
+    parser.add_argument("--karaoke_rate", help="rate of titles with karaoke version", type=float, default=0.05)
+    parser.add_argument("--seed", help="random seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rand = random.Random(args.seed)
+    with open(args.output, 'wt', encoding='utf-8', newline='\n') as file_pointer:
+        for line in generate(rand, args.titles, args.mbid_rate, args.karaoke_rate):
+            file_pointer.write(line + '\n')
+    if args.dict:
+        # musiclist2json.py -d に渡す英単語の読み
+        words = {word: kana_word(random.Random(word), 2, 5) for word in ENGLISH}
+        words.update({'The': 'ザ', 'feat': 'フィーチャリング', 'Various': 'ヴァリアス', 'Artists': 'アーティスツ',
+                      'Instrumental': 'インストゥルメンタル', 'less': 'レス', 'vocal': 'ボーカル'})
+        with open(args.dict, 'wt', encoding='utf-8', newline='\n') as file_pointer:
+            json.dump(words, file_pointer, ensure_ascii=False, sort_keys=True, indent=4)
+    return True
+
+if __name__ == '__main__':
+    main()
@@ -9,9 +9,12 @@ import re
 import os
 import codecs
 import argparse
+import functools
+import hashlib
 import json
 import unicodedata
 import itertools
+from collections import Counter
 
 # pylint: disable-msg=C0301
 
@@ -26,38 +29,192 @@ import itertools
 
 # pylint: enable-msg=C0301
 
+READABLE_CACHE_SIZE = 1 << 16
+RE_TRACK_PREFIX = re.compile(r"^([0-9\-]+)\s")
+RE_TIMESTAMP = re.compile(r"\s\d{4}\-\d{2}\-\d{2}\s\d{2}:\d{2}:\d{2}$")
+RE_KARAOKE = re.compile(r"(Karaoke|karaoke|KARAOKE|less vocal|カラオケ|インスト)")
+RE_ASCII_WORD = re.compile(r"[!-~]+")
+RE_TRIM_TIME = re.compile(r"^\d+:\d+:\d+$")
+RE_TRIM_HEAD = re.compile(r"^[\s~<>\"\(\)\[\]{}\\\-_;:,]+")
+RE_TRIM_TAIL = re.compile(r"[\s~<>\"\(\)\[\]{}\\\-_;:]+$")
+RE_TRIM_SYMBOL = re.compile(r"[~<>\"\(\)\[\]{}\\\-_;:]")
+RE_TRIM_EMPTY = re.compile(r"^[\s!\?]*$")
+
+@functools.lru_cache(maxsize=READABLE_CACHE_SIZE)
 def isReadable(s):
-    s = re.sub(r"\s+", " ", s)
-    s = re.sub(r"^\s*", "", s)
-    s = re.sub(r"\s*$", "", s)
-    if not len(s):
+    """ cp932 で表せない文字が2割以下か。アーティスト・アルバム名は何度も出てくるのでキャッシュする """
+    s = ' '.join(s.split())
+    if not s:
         return False
+    try:
+        # ほとんどの名前はそのまま cp932 にできる
+        s.encode('cp932')
+        return True
+    except UnicodeEncodeError:
+        pass
     conv = codecs.encode(s, 'cp932', errors='replace')
     conv2 = codecs.decode(conv, 'cp932')
-    n = len(re.findall(r'\?', conv2)) - len(re.findall(r'\?', s))
+    n = conv2.count('?') - s.count('?')
     if n > len(s) * 0.2:
         return False
     return True
 
-def split_path(path):
+@functools.lru_cache(maxsize=READABLE_CACHE_SIZE)
+def nfkc(s):
+    """ NFKC 正規化 (キャッシュつき) """
+    return unicodedata.normalize('NFKC', s)
+
+@functools.lru_cache(maxsize=READABLE_CACHE_SIZE)
+def split_dir(path):
+    """ ディレクトリのパスを要素に分ける。同じアルバムの曲は同じディレクトリなのでキャッシュする """
     pathlist = []
     head, tail = path_parser.split(path)
     while tail:
         pathlist.insert(0, tail)
         head, tail = path_parser.split(head)
-    return pathlist
+    return tuple(pathlist)
+
+def split_path(path):
+    head, tail = path_parser.split(path)
+    if not tail:
+        return []
+    return list(split_dir(head)) + [tail]
 
+@functools.lru_cache(maxsize=READABLE_CACHE_SIZE)
 def word_trim(w):
-    w = re.sub(r"^\d+:\d+:\d+$", "", w)
-    w = re.sub(r"^[\s~<>\"\(\)\[\]{}\\\-_;:,]+", "", w)
-    w = re.sub(r"[\s~<>\"\(\)\[\]{}\\\-_;:]+$", "", w)
-    w = re.sub(r"[~<>\"\(\)\[\]{}\\\-_;:]", " ", w)
-    w = re.sub(r"^[\s!\?]*$", "", w)
-    return w.split()
+    """ ASCII の語から記号を除いて単語に分ける。feat, Remix の様に同じ語が何度も出てくるのでキャッシュする """
+    w = RE_TRIM_TIME.sub("", w)
+    w = RE_TRIM_HEAD.sub("", w)
+    w = RE_TRIM_TAIL.sub("", w)
+    w = RE_TRIM_SYMBOL.sub(" ", w)
+    w = RE_TRIM_EMPTY.sub("", w)
+    return tuple(w.split())
+
+class Transliterator:
+    """ 名前の中の ASCII の語を、辞書で読みに置き換える
+
+    語 -> 読み はメモしておき、辞書に無かった単語とその出現回数を数える
+    """
+    def __init__(self, yomidic):
+        self.yomidic = yomidic
+        self.memo = {}
+        self.token_counts = Counter()
+
+    def token_yomi(self, token):
+        """ ASCII の語の読み """
+        yomi = self.memo.get(token)
+        if yomi is None:
+            yomi = self.memo[token] = " ".join([self.yomidic.get(w, w) for w in word_trim(token)])
+        return yomi
+
+    def _repl(self, matchobj):
+        token = matchobj.group(0)
+        self.token_counts[token] += 1
+        return self.token_yomi(token)
+
+    def __call__(self, name):
+        return RE_ASCII_WORD.sub(self._repl, name)
+
+    def uncovered(self):
+        """ 辞書に無かった単語 -> 出現回数 (多い順) """
+        counts = Counter()
+        for token, count in self.token_counts.items():
+            for w in word_trim(token):
+                if w not in self.yomidic:
+                    counts[w] += count
+        return dict(sorted(counts.items(), key=lambda item: (-item[1], item[0])))
+
+def write_json(f, data, depth=2):
+    """ json.dump(data, f, ensure_ascii=False, sort_keys=True) と同じものを書く
+
+    json.dump は要素ごとに Python の encoder で書くので遅い。
+    depth 段目までの辞書は要素ごとに json.dumps (C の encoder) して書き、
+    全体を1つの文字列にはしない
+    """
+    if depth and isinstance(data, dict):
+        f.write('{')
+        for i, key in enumerate(sorted(data)):
+            if i:
+                f.write(', ')
+            f.write(json.dumps(key, ensure_ascii=False))
+            f.write(': ')
+            write_json(f, data[key], depth - 1)
+        f.write('}')
+    else:
+        f.write(json.dumps(data, ensure_ascii=False, sort_keys=True))
+
+def read_manifest(path):
+    """ 前回の manifest を読む。無ければ空 """
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
 
-artistId = 0
-albumId = 0
-titleId = 0
+def track_digests(path):
+    """ beets の出力の各行を mb_trackid (無ければパス) をキーにしたダイジェストにする """
+    tracks = {}
+    with open(path, "rb") as f:
+        for line in f:
+            line = line.rstrip(b'\r\n')
+            fields = line.split(b'\t')
+            key = (fields[10] or fields[0]).decode('utf-8')
+            if key in tracks:
+                # 同じ mb_trackid のファイルが複数ある時はパスで区別する
+                key += '\t' + fields[0].decode('utf-8')
+            tracks[key] = hashlib.sha1(line).hexdigest()[:16]
+    return tracks
+
+def file_digest(path):
+    """ ファイルのダイジェスト。パスが無ければ None """
+    if not path:
+        return None
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()[:16]
+
+class IdAssigner:
+    """ MusicBrainz の ID が無いものに ART00000001 の様な ID を割り当てる
+
+    前回の manifest で割り当てたキーには同じ ID を返すので、曲を足したり
+    消したりしても他の ID は変わらない。新しい ID は前回の続きの番号にする
+    """
+    def __init__(self, prefix, previous=None):
+        previous = previous or {}
+        self.prefix = prefix
+        self.previous = previous.get('ids', {})
+        self.next = previous.get('next', 0)
+        # 今回割り当てたキー -> ID (manifest に残す)
+        self.ids = {}
+
+    def __call__(self, key):
+        item_id = self.ids.get(key)
+        if item_id is None:
+            item_id = self.previous.get(key)
+            if item_id is None:
+                item_id = '{}{:08d}'.format(self.prefix, self.next)
+                self.next += 1
+            self.ids[key] = item_id
+        return item_id
+
+    def state(self):
+        """ manifest に書く割り当て """
+        return {'ids': self.ids, 'next': self.next}
+
+class PendingId:
+    """ まだ決まらないアーティストID
+
+    ID の無い行のアーティストは、後の行に出てくる同じ名前の ID で決まるので、
+    読み終わってから名前で引き、無ければ key で割り当てる
+    """
+    __slots__ = ['name', 'key', 'value']
+
+    def __init__(self, name, key):
+        self.name = name
+        self.key = key
+        self.value = None
+
+def resolve_id(item_id):
+    """ PendingId なら決まった ID にする """
+    return item_id.value if isinstance(item_id, PendingId) else item_id
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-l", "--list", help="file of iTunes music title list.", type=str)
@@ -65,12 +222,30 @@ parser.add_argument("-d", "--dict", help="file of word to kana dictionary.", typ
 parser.add_argument("-o", "--output", help="output json file", type=str)
 parser.add_argument("--path_parser", help="select path parser", type=str, choices=['posix', 'win'])
 parser.add_argument("--pathdrop", help="drop leading path", type=int, default=6)
+parser.add_argument("--uncovered", help="output words not in the dictionary with their counts", type=str)
+parser.add_argument("--manifest", help="track manifest file. skip when the list has not changed", type=str)
 args = parser.parse_args()
 
 if (not args.list) or (not args.output):
     parser.print_help()
     exit(1)
 
+manifest = {}
+if args.manifest:
+    # 前回の manifest と曲・設定が同じなら、出力はそのままにする
+    manifest = read_manifest(args.manifest)
+    tracks = track_digests(args.list)
+    options = {'dict': file_digest(args.dict), 'path_parser': args.path_parser, 'pathdrop': args.pathdrop}
+    old_tracks = manifest.get('tracks', {})
+    added = tracks.keys() - old_tracks.keys()
+    removed = old_tracks.keys() - tracks.keys()
+    changed = [key for key in tracks.keys() & old_tracks.keys() if tracks[key] != old_tracks[key]]
+    print('tracks: {} added, {} removed, {} changed'.format(len(added), len(removed), len(changed)))
+    if (not added and not removed and not changed and manifest.get('options') == options
+            and manifest.get('output') == args.output and os.path.exists(args.output)):
+        print('no changes: {}'.format(args.output))
+        exit(0)
+
 if args.path_parser == 'posix':
     import posixpath
     path_parser = posixpath
@@ -80,12 +255,23 @@ elif args.path_parser == 'win':
 else:
     path_parser = os.path
 
-musicList = []
-artistDict = {}
+# 生成する ID。アルバムアーティストは名前、アルバムはアルバムアーティストとアルバム名、
+# 曲とその曲だけのアーティストはパスをキーにする
+assigned_ids = manifest.get('ids', {})
+artist_ids = IdAssigner('ART', assigned_ids.get('artist', None))
+album_ids = IdAssigner('ALB', assigned_ids.get('album', None))
+title_ids = IdAssigner('TTL', assigned_ids.get('title', None))
+
 albumDict = {}
 titleDict = {}
 musicDict = {}
+# MusicBrainz の ID がある行の、名前 -> アーティストID (後の行ほど優先)
+namedArtistDict = {}
+# 作った順の PendingId
+pending_ids = []
 
+# 1行ずつ読みながら正規化して、そのまま musicDict に登録する
+track_from_name = None
 with open(args.list, "rt", encoding='utf-8') as f:
     for line in f:
         line = line.rstrip('\n')
@@ -97,104 +283,115 @@ with open(args.list, "rt", encoding='utf-8') as f:
         if args.pathdrop:
             path_list = path_list[args.pathdrop:]
         path = path_parser.join(*path_list)
-        dirname, fname = path_parser.split(path)
+        fname = path_list[-1]
         base, ext = path_parser.splitext(fname)
-        res = re.match(r"^([0-9\-]+)\s", fname)
+        res = RE_TRACK_PREFIX.match(fname)
         if res:
             track_from_name = res.group(0)
         if not isReadable(title):
             title = base
-            title = re.sub(r"^([0-9\-]+)\s", "", title)
+            title = RE_TRACK_PREFIX.sub("", title)
         if not track and track_from_name:
             track = track_from_name
         if not isReadable(albumartist):
             albumartist = path_list[0]
         if not isReadable(album):
             album = path_list[1]
-        title = re.sub(r"\s\d{4}\-\d{2}\-\d{2}\s\d{2}:\d{2}:\d{2}$", "", title)
-        if isReadable(title):
-            albumartist = unicodedata.normalize('NFKC', albumartist)
-            artist = unicodedata.normalize('NFKC', artist)
-            if not artist:
-                artist = albumartist
-            album = unicodedata.normalize('NFKC', album)
-            title = unicodedata.normalize('NFKC', title)
-            musicList.append({'path': path, 'albumartist': albumartist, 'album': album, 'artist': artist,
-                              'disc': disc, 'track': track, 'title':title, 'albumartist_id': albumartist_id,
-                              'album_id': album_id, 'artist_id': artist_id, 'title_id': title_id})
-            if (albumartist_id and albumartist and not albumartist_id in artistDict):
-                artistDict[albumartist] = {'id': albumartist_id}
-            if (artist_id and not artist_id in artistDict):
-                artistDict[artist] = {'id': artist_id}
-            if (album_id and not album_id in albumDict):
-                albumDict[album] = {'id': album_id}
-            if (title_id and not title_id in titleDict):
-                titleDict[title] = {'id': title_id}
-
-for m in musicList:
-    if not m['albumartist_id']:
-        if m['albumartist'] in artistDict:
-            m['albumartist_id'] = artistDict[m['albumartist']]['id']
-        else:
-            m['albumartist_id'] = 'ART{:08d}'.format(artistId)
-            artistId += 1
-    if not m['artist_id']:
-        if m['artist'] in artistDict:
-            m['artist_id'] = artistDict[m['artist']]['id']
-        else:
-            m['artist_id'] = 'ART{:08d}'.format(artistId)
-            artistId += 1
-    if not m['albumartist'] in musicDict:
-        artistDict[m['albumartist']] = {'id': m['albumartist_id']}
-        musicDict[m['albumartist']] = {'id': m['albumartist_id'], 'album': {}}
-    albums = musicDict[m['albumartist']]['album']
-    if not m['album_id']:
-        if m['album'] in albums:
-            m['album_id'] = albums[m['album']]['id']
-        else:
-            m['album_id'] = 'ALB{:08d}'.format(albumId)
-            albumId += 1
-    if not m['album'] in albums:
-        albumDict[m['album']] = {'id': m['album_id']}
-        albums[m['album']] = {
-            'id': m['album_id'], 'albumartist_id': m['albumartist_id'], 'title':{}
-        }
-    titles = albums[m['album']]['title']
-    if not m['title_id']:
-        if m['title'] in titles:
-            m['title_id'] = titles[m['title']]['id']
-        else:
-            m['title_id'] = 'TTL{:08d}'.format(titleId)
-            titleId += 1
-    if not m['title'] in titles:
-        titleDict[title] = {'id': m['title_id']}
-        if re.search(r"(Karaoke|karaoke|KARAOKE|less vocal|カラオケ|インスト)", m['title']):
-            iskaraoke = True
-        else:
-            iskaraoke = False
-        titles[m['title']] = {
-            'id': m['title_id'], 'artist': m['artist'], 'artist_id': m['artist_id'],
-            'disc': m['disc'], 'track': m['track'], 'karaoke':iskaraoke, 'path': m['path'],
-            'album_id': m['album_id'], 'albumartist_id': m['albumartist_id']
-        }
+        title = RE_TIMESTAMP.sub("", title)
+        if not isReadable(title):
+            continue
+        albumartist = nfkc(albumartist)
+        artist = nfkc(artist)
+        if not artist:
+            artist = albumartist
+        album = nfkc(album)
+        title = unicodedata.normalize('NFKC', title)
+        if (albumartist_id and albumartist and not albumartist_id in namedArtistDict):
+            namedArtistDict[albumartist] = albumartist_id
+        if (artist_id and not artist_id in namedArtistDict):
+            namedArtistDict[artist] = artist_id
+
+        if not albumartist_id:
+            if albumartist in musicDict:
+                albumartist_id = musicDict[albumartist]['id']
+            else:
+                albumartist_id = PendingId(albumartist, albumartist)
+                pending_ids.append(albumartist_id)
+        if not artist_id:
+            if artist in musicDict:
+                artist_id = musicDict[artist]['id']
+            else:
+                # これまで通り曲ごとに割り当てる。名前のキーと重ならない様にタブを前に付ける
+                artist_id = PendingId(artist, '\t' + path)
+                pending_ids.append(artist_id)
+        if not albumartist in musicDict:
+            musicDict[albumartist] = {'id': albumartist_id, 'album': {}}
+        albums = musicDict[albumartist]['album']
+        if not album_id:
+            if album in albums:
+                album_id = albums[album]['id']
+            else:
+                album_id = album_ids(albumartist + '\t' + album)
+        if not album in albums:
+            albumDict[album] = {'id': album_id}
+            albums[album] = {
+                'id': album_id, 'albumartist_id': albumartist_id, 'title':{}
+            }
+        titles = albums[album]['title']
+        if not title_id:
+            if title in titles:
+                title_id = titles[title]['id']
+            else:
+                title_id = title_ids(path)
+        if not title in titles:
+            titleDict[title] = {'id': title_id}
+            iskaraoke = bool(RE_KARAOKE.search(title))
+            titles[title] = {
+                'id': title_id, 'artist': artist, 'artist_id': artist_id,
+                'disc': disc, 'track': track, 'karaoke':iskaraoke, 'path': path,
+                'album_id': album_id, 'albumartist_id': albumartist_id
+            }
+
+# 読み終わったので、まだ決まっていないアーティストIDを出てきた順に決める
+for pending_id in pending_ids:
+    pending_id.value = namedArtistDict.get(pending_id.name) or artist_ids(pending_id.key)
+del pending_ids
+for artist_entry in musicDict.values():
+    artist_entry['id'] = resolve_id(artist_entry['id'])
+    for album_entry in artist_entry['album'].values():
+        album_entry['albumartist_id'] = resolve_id(album_entry['albumartist_id'])
+        for title_entry in album_entry['title'].values():
+            title_entry['artist_id'] = resolve_id(title_entry['artist_id'])
+            title_entry['albumartist_id'] = resolve_id(title_entry['albumartist_id'])
+artistDict = {name: {'id': artist_id} for name, artist_id in namedArtistDict.items()}
+for artist_name, artist_entry in musicDict.items():
+    artistDict[artist_name] = {'id': artist_entry['id']}
 
 if not args.dict:
     words = set()
     for name in artistDict.keys() | albumDict.keys() | titleDict.keys():
-        arr = re.findall(r"[!-~]+", name)
-        for w in arr:
-            words |= set(word_trim(w))
+        for w in RE_ASCII_WORD.findall(name):
+            words.update(word_trim(w))
     with open(args.output, "wt", encoding='utf-8', newline='\n') as f:
         json.dump(list(words), f, ensure_ascii=False, sort_keys=True, indent=4)
 else:
     with open(args.dict, encoding='utf-8') as f:
         yomidic = json.load(f)
+    transliterate = Transliterator(yomidic)
     for name, entry in itertools.chain(artistDict.items(), albumDict.items(), titleDict.items()):
-        def repl(matchobj):
-            arr = word_trim(matchobj.group(0))
-            return " ".join([yomidic.get(w, w) for w in arr])
-        yomi = re.sub(r"[!-~]+", repl, name)
-        entry['yomi'] = yomi
+        entry['yomi'] = transliterate(name)
+    if args.uncovered:
+        # 辞書に足すべき単語。多く出てくるものから
+        uncovered = transliterate.uncovered()
+        print('uncovered words: {}'.format(len(uncovered)))
+        with open(args.uncovered, "wt", encoding='utf-8', newline='\n') as f:
+            json.dump(uncovered, f, ensure_ascii=False, indent=4)
     data = {'artist': artistDict, 'album': albumDict, 'title': titleDict, 'music': musicDict}
     with open(args.output, "wt", encoding='utf-8', newline='\n') as f:
-        json.dump(data, f, ensure_ascii=False, sort_keys=True)
+        write_json(f, data)
+
+if args.manifest:
+    with open(args.manifest, "wt", encoding='utf-8', newline='\n') as f:
+        ids = {'artist': artist_ids.state(), 'album': album_ids.state(), 'title': title_ids.state()}
+        json.dump({'output': args.output, 'options': options, 'tracks': tracks, 'ids': ids}, f,
+                  ensure_ascii=False, sort_keys=True, indent=1)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+"""
+MusicSearch の再生リストの組み立て (カラオケの扱い) の試験
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda', 'py'))
+
+import musicsearch # pylint: disable=wrong-import-position
+
+TITLES = {
+    't1': {'id': 't1', 'name': '夜明け', 'karaoke': False},
+    't2': {'id': 't2', 'name': '夜明け (オリジナル・カラオケ)', 'karaoke': True},
+    't3': {'id': 't3', 'name': '夕暮れ', 'karaoke': False},
+    'k1': {'id': 'k1', 'name': '夜明け (カラオケ)', 'karaoke': True},
+    'k2': {'id': 'k2', 'name': '夕暮れ (カラオケ)', 'karaoke': True},
+}
+ALBUMS = {
+    # 本編とカラオケの混じったアルバム
+    'mixed': {'id': 'mixed', 'name': '夜明け', 'title': ['t1', 't2', 't3'], 'playable': ['t1', 't3']},
+    # カラオケだけのアルバム
+    'karaoke': {'id': 'karaoke', 'name': 'カラオケ集', 'title': ['k1', 'k2'], 'playable': []},
+}
+ARTISTS = {
+    'a1': {'id': 'a1', 'name': '歌手', 'title': ['t1', 't2', 't3', 'k1', 'k2'], 'playable': ['t1', 't3']},
+}
+
+class FakeMusicDb:
+    """ 上の表だけを持つ MusicDb の代わり """
+    def __init__(self, playable=True):
+        tables = {'artist': ARTISTS, 'album': ALBUMS, 'title': TITLES}
+        if not playable:
+            # playable の無い古い database
+            tables = {item_type: {item_id: {key: value for key, value in item.items() if key != 'playable'}
+                                  for item_id, item in table.items()}
+                      for item_type, table in tables.items()}
+        self.tables = tables
+
+    def get_item_by_id(self, item_type, item_id):
+        """ MusicDb.get_item_by_id と同じ """
+        return self.tables[item_type].get(item_id, None)
+
+    def get_artist_by_id(self, item_id):
+        """ MusicDb.get_artist_by_id と同じ """
+        return self.get_item_by_id('artist', item_id)
+
+    def get_album_by_id(self, item_id):
+        """ MusicDb.get_album_by_id と同じ """
+        return self.get_item_by_id('album', item_id)
+
+    def get_title_by_id(self, item_id):
+        """ MusicDb.get_title_by_id と同じ """
+        return self.get_item_by_id('title', item_id)
+
+def music_search(playable=True):
+    """ FakeMusicDb を使う MusicSearch """
+    search = musicsearch.MusicSearch()
+    search.music_db = FakeMusicDb(playable)
+    return search
+
+class AlbumKaraokeTest(unittest.TestCase):
+    """ アルバムの再生リスト """
+    def test_mixed_album_skips_karaoke(self):
+        """ 本編のあるアルバムからはカラオケを除いて、曲順のまま再生する """
+        for playable in [True, False]:
+            play_list = music_search(playable).get_play_list(album_id='mixed')
+            music_search(playable).expansion_list(play_list)
+            self.assertEqual(play_list['list'], ['t1', 't3'])
+            self.assertFalse(play_list['shuffle'])
+
+    def test_mixed_album_with_karaoke(self):
+        """ カラオケを明示されたら全曲を再生する """
+        play_list = music_search().get_play_list(album_id='mixed')
+        music_search().expansion_list(play_list, include_karaoke=True)
+        self.assertEqual(play_list['list'], ['t1', 't2', 't3'])
+
+    def test_karaoke_only_album(self):
+        """ カラオケしか無いアルバムはそのまま全曲を再生する """
+        for playable in [True, False]:
+            play_list = music_search(playable).get_play_list(album_id='karaoke')
+            music_search(playable).expansion_list(play_list)
+            self.assertEqual(play_list['list'], ['k1', 'k2'])
+
+class ArtistListTest(unittest.TestCase):
+    """ アーティストの再生リスト """
+    def test_artist_id_list_built_once(self):
+        """ ID で引いた時も曲リストは expansion_list で seed から1回だけ作る """
+        search = music_search()
+        play_list = search.get_play_list(artist_id='a1')
+        self.assertNotIn('list', play_list)
+        search.expansion_list(play_list)
+        self.assertEqual(sorted(play_list['list']), ['t1', 't3'])
+        self.assertEqual(play_list['list'], search.build_title_list('artist', 'a1', seed=play_list['seed']))
+
+if __name__ == '__main__':
+    unittest.main()
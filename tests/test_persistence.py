@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+"""
+CachedDynamoDbAdapter のキャッシュと、version の条件付き書き込みがぶつかった時の試験
+"""
+
+import copy
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda', 'py'))
+# DynamoDbAdapter の既定引数が import 時に boto3 の resource を作る
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+try:
+    from botocore.exceptions import ClientError
+    from ask_sdk_core.exceptions import PersistenceException
+    import persistence # pylint: disable=wrong-import-position
+except ImportError:
+    # ask_sdk の入っていない環境
+    persistence = None
+
+class FakeTable:
+    """ 1つの item だけを持つ DynamoDB の Table の代わり。呼ばれた回数を数える """
+    def __init__(self):
+        self.items = {}
+        self.calls = {'get_item': 0, 'put_item': 0, 'update_item': 0}
+
+    @staticmethod
+    def _check(item, condition, values):
+        """ version の条件を調べる """
+        if condition == 'attribute_not_exists(#version)':
+            ok = item is None or 'version' not in item
+        else:
+            ok = item is not None and item.get('version') == values[':version']
+        if not ok:
+            raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'write')
+
+    def get_item(self, Key, ConsistentRead): # pylint: disable=invalid-name
+        """ item を読む """
+        self.calls['get_item'] += 1
+        item = self.items.get(Key['id'], None)
+        return {'Item': copy.deepcopy(item)} if item is not None else {}
+
+    def put_item(self, Item, ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues=None): # pylint: disable=invalid-name,unused-argument
+        """ item を書く """
+        self.calls['put_item'] += 1
+        self._check(self.items.get(Item['id'], None), ConditionExpression, ExpressionAttributeValues or {})
+        self.items[Item['id']] = copy.deepcopy(Item)
+
+    def update_item(self, Key, UpdateExpression, ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues): # pylint: disable=invalid-name
+        """ SET / REMOVE だけの UpdateExpression を適用する """
+        self.calls['update_item'] += 1
+        item = self.items.get(Key['id'], None)
+        self._check(item, ConditionExpression, ExpressionAttributeValues)
+        set_part, _, remove_part = UpdateExpression[len('SET '):].partition(' REMOVE ')
+        def resolve(path):
+            names = [ExpressionAttributeNames[name] for name in path.split('.')]
+            parent = item
+            for name in names[:-1]:
+                parent = parent[name]
+            return parent, names[-1]
+        for assignment in set_part.split(', '):
+            path, value = assignment.split(' = ')
+            parent, name = resolve(path)
+            parent[name] = copy.deepcopy(ExpressionAttributeValues[value])
+        for path in remove_part.split(', ') if remove_part else []:
+            parent, name = resolve(path)
+            parent.pop(name, None)
+
+class FakeResource:
+    """ boto3 の dynamodb resource の代わり """
+    def __init__(self, table):
+        self.table = table
+
+    def Table(self, name): # pylint: disable=invalid-name,unused-argument
+        """ テーブルを得る """
+        return self.table
+
+def adapter(table, **kwargs):
+    """ リクエストの envelope をそのまま partition key にする CachedDynamoDbAdapter """
+    return persistence.CachedDynamoDbAdapter(
+        table_name='test', partition_keygen=lambda envelope: envelope,
+        dynamodb_resource=FakeResource(table), **kwargs)
+
+def play_queue(**fields):
+    """ 永続属性の play_queue """
+    queue = {'type': 'album', 'id': 'a1', 'index': 0, 'state': 'PLAYING'}
+    queue.update(fields)
+    return queue
+
+@unittest.skipIf(persistence is None, 'ask_sdk is not installed')
+class CacheTest(unittest.TestCase):
+    """ コンテナ内キャッシュ """
+    def test_cache_hit_skips_get_item(self):
+        """ 書いた後のリクエストは TTL の間 GetItem しない """
+        table = FakeTable()
+        store = adapter(table)
+        attributes = store.get_attributes('user')
+        attributes['play_queue'] = play_queue()
+        store.save_attributes('user', attributes)
+        calls = table.calls['get_item']
+        self.assertEqual(store.get_attributes('user'), {'play_queue': play_queue()})
+        self.assertEqual(table.calls['get_item'], calls)
+
+    def test_stale_cache_caught_by_write(self):
+        """ 他のコンテナが書いた後の古いキャッシュは、書く時に気付いて重ね直す """
+        table = FakeTable()
+        mine = adapter(table)
+        other = adapter(table)
+        attributes = mine.get_attributes('user')
+        attributes['play_queue'] = play_queue()
+        mine.save_attributes('user', attributes)
+
+        theirs = other.get_attributes('user')
+        theirs['play_queue']['index'] = 5
+        other.save_attributes('user', theirs)
+
+        attributes = mine.get_attributes('user')
+        attributes['play_queue']['state'] = 'STOPPED'
+        self.assertTrue(mine.update_attributes('user', attributes, 'play_queue', {'state': 'STOPPED'},
+                                               volatile={'index', 'state'}))
+        self.assertEqual(table.items['user']['attributes']['play_queue'], play_queue(index=5, state='STOPPED'))
+        self.assertEqual(mine.get_attributes('user')['play_queue'], play_queue(index=5, state='STOPPED'))
+
+@unittest.skipIf(persistence is None, 'ask_sdk is not installed')
+class ConflictTest(unittest.TestCase):
+    """ 読んでから書くまでの間に他が書いた時 """
+    def setUp(self):
+        self.table = FakeTable()
+        first = adapter(self.table)
+        attributes = first.get_attributes('user')
+        attributes['play_queue'] = play_queue()
+        attributes['volume'] = 3
+        first.save_attributes('user', attributes)
+
+    def write_other(self, **changes):
+        """ 別のコンテナとして書く """
+        other = adapter(self.table)
+        attributes = other.get_attributes('user')
+        attributes.update(changes)
+        other.save_attributes('user', attributes)
+
+    def test_update_without_cache(self):
+        """ キャッシュを使わない設定でも、ぶつかったら読み直して書ける """
+        for kwargs in [{'cache_size': 0}, {'cache_ttl': 0}]:
+            store = adapter(self.table, **kwargs)
+            attributes = store.get_attributes('user')
+            self.write_other(volume=4)
+            attributes['play_queue']['index'] = 1
+            self.assertTrue(store.update_attributes('user', attributes, 'play_queue', {'index': 1},
+                                                    volatile={'index'}))
+            item = self.table.items['user']['attributes']
+            self.assertEqual(item['play_queue']['index'], 1)
+            self.assertEqual(item['volume'], 4)
+
+    def test_update_keeps_replaced_queue(self):
+        """ 他のリクエストが再生キューを作り直していたら、そちらを残す """
+        store = adapter(self.table)
+        attributes = store.get_attributes('user')
+        self.write_other(play_queue=play_queue(id='a2'))
+        attributes['play_queue']['index'] = 1
+        self.assertTrue(store.update_attributes('user', attributes, 'play_queue', {'index': 1},
+                                                volatile={'index'}))
+        self.assertEqual(self.table.items['user']['attributes']['play_queue'], play_queue(id='a2'))
+        self.assertEqual(attributes['play_queue'], play_queue(id='a2'))
+
+    def test_save_merges_other_keys(self):
+        """ 違うキーの変更は両方残す """
+        store = adapter(self.table)
+        attributes = store.get_attributes('user')
+        self.write_other(volume=4)
+        attributes['play_queue'] = play_queue(id='a2')
+        store.save_attributes('user', attributes)
+        item = self.table.items['user']['attributes']
+        self.assertEqual(item, {'play_queue': play_queue(id='a2'), 'volume': 4})
+        self.assertEqual(attributes, item)
+
+    def test_save_rejects_same_key(self):
+        """ 同じキーを両方が変えていたら、他の書き込みを上書きせずに例外にする """
+        store = adapter(self.table)
+        attributes = store.get_attributes('user')
+        self.write_other(play_queue=play_queue(id='a3'))
+        attributes['play_queue'] = play_queue(id='a2')
+        with self.assertRaises(PersistenceException):
+            store.save_attributes('user', attributes)
+        self.assertEqual(self.table.items['user']['attributes']['play_queue'], play_queue(id='a3'))
+        # 次のリクエストは読み直す
+        self.assertEqual(store.get_attributes('user')['play_queue'], play_queue(id='a3'))
+
+if __name__ == '__main__':
+    unittest.main()
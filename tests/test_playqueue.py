@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+"""
+再生キュー (トークン・再生位置・seed からの組み立て・変わった所だけの保存) の試験
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda', 'py'))
+
+import musicsearch # pylint: disable=wrong-import-position
+import playqueue # pylint: disable=wrong-import-position
+
+class FakeMusicDb:
+    """ 1人のアーティストだけを持つ MusicDb の代わり """
+    def __init__(self):
+        self.artist = {'id': 'a1', 'name': '歌手', 'title': ['t1', 't2', 't3', 't4', 't5'],
+                       'playable': ['t1', 't2', 't3', 't4', 't5']}
+        self.lookups = 0
+
+    def get_version(self):
+        """ MusicDb.get_version と同じ """
+        return 'v1'
+
+    def get_item_by_id(self, item_type, item_id):
+        """ MusicDb.get_item_by_id と同じ """
+        self.lookups += 1
+        return self.artist if (item_type, item_id) == ('artist', 'a1') else None
+
+    def get_artist_by_id(self, item_id):
+        """ MusicDb.get_artist_by_id と同じ """
+        return self.get_item_by_id('artist', item_id)
+
+class FakeMusicSearch:
+    """ 決まった曲リストを返す MusicSearch の代わり """
+    def __init__(self, title_list):
+        self.title_list = title_list
+
+    def get_db(self):
+        """ MusicSearch.get_db と同じ """
+        return FakeMusicDb()
+
+    def build_title_list(self, item_type, item_id, seed=None, include_karaoke=False): # pylint: disable=unused-argument
+        """ MusicSearch.build_title_list と同じ """
+        return list(self.title_list)
+
+class FakeAttributesManager:
+    """ ask_sdk の AttributesManager の代わり """
+    def __init__(self, attributes):
+        self.persistent_attributes = attributes
+        self.saves = 0
+
+    def save_persistent_attributes(self):
+        """ item を丸ごと書く """
+        self.saves += 1
+
+class FakeAdapter:
+    """ update_attributes を持つアダプタの代わり """
+    def __init__(self, result=True):
+        self.result = result
+        self.calls = []
+
+    def update_attributes(self, request_envelope, attributes, name, values, removed=(), volatile=()): # pylint: disable=too-many-arguments
+        """ 呼ばれた引数を記録する """
+        self.calls.append((request_envelope, name, values, list(removed), set(volatile)))
+        return self.result
+
+def queue_attributes(**fields):
+    """ 永続属性の play_queue """
+    attributes = {'type': 'album', 'id': 'b1', 'seed': None, 'count': 3, 'index': 0,
+                  'state': 'PLAYING', 'playback_failure_count': 0}
+    attributes.update(fields)
+    return attributes
+
+class TokenTest(unittest.TestCase):
+    """ ストリームのトークン """
+    def test_round_trip(self):
+        """ 位置と曲IDを埋め込んで取り出せる """
+        self.assertEqual(playqueue.make_token(3, 't1'), '3:t1')
+        self.assertEqual(playqueue.parse_token(playqueue.make_token(3, 't1')), (3, 't1'))
+
+    def test_legacy_token(self):
+        """ 曲IDだけの古いトークンは位置が None """
+        self.assertEqual(playqueue.parse_token('t1'), (None, 't1'))
+        self.assertEqual(playqueue.parse_token('x:t1'), (None, 'x:t1'))
+        self.assertEqual(playqueue.parse_token(''), (None, ''))
+        self.assertEqual(playqueue.parse_token(None), (None, None))
+
+class PositionTest(unittest.TestCase):
+    """ PlayQueue.position_of """
+    def setUp(self):
+        playqueue.TITLE_LIST_CACHE.clear()
+        self.queue = playqueue.PlayQueue(queue_attributes(), FakeMusicSearch(['t1', 't2', 't1']))
+
+    def test_token_with_index(self):
+        """ 同じ曲が2回あっても、トークンの位置を返す """
+        self.assertEqual(self.queue.position_of(playqueue.make_token(2, 't1')), 2)
+        self.assertEqual(self.queue.position_of(playqueue.make_token(0, 't1')), 0)
+
+    def test_token_not_in_list(self):
+        """ 位置の曲が違う・リストの外なら None """
+        self.assertIsNone(self.queue.position_of(playqueue.make_token(1, 't1')))
+        self.assertIsNone(self.queue.position_of(playqueue.make_token(3, 't1')))
+
+    def test_legacy_token(self):
+        """ 古いトークンは曲IDの最初の位置 """
+        self.assertEqual(self.queue.position_of('t2'), 1)
+        self.assertEqual(self.queue.position_of('t1'), 0)
+        self.assertIsNone(self.queue.position_of('t9'))
+
+class SeedTest(unittest.TestCase):
+    """ seed からの曲リストの組み立て """
+    def setUp(self):
+        playqueue.TITLE_LIST_CACHE.clear()
+
+    def test_rebuilt_from_seed(self):
+        """ 曲リストを保存しなくても、同じ seed から同じ順序に組み立て直す """
+        search = musicsearch.MusicSearch()
+        search.music_db = FakeMusicDb()
+        play_list = search.get_play_list(artist_id='a1')
+        search.expansion_list(play_list)
+        attributes = playqueue.create_attributes(play_list)
+        self.assertNotIn('list', attributes)
+
+        queue = playqueue.PlayQueue(dict(attributes), search)
+        self.assertEqual(queue.title_list, play_list['list'])
+        # 別のコンテナでキャッシュが無くても同じ
+        playqueue.TITLE_LIST_CACHE.clear()
+        self.assertEqual(playqueue.PlayQueue(dict(attributes), search).title_list, play_list['list'])
+
+    def test_cached_between_events(self):
+        """ 同じ再生キューの曲リストはキャッシュから使い回す """
+        search = musicsearch.MusicSearch()
+        search.music_db = FakeMusicDb()
+        attributes = queue_attributes(type='artist', id='a1', seed=7, count=5)
+        title_list = playqueue.PlayQueue(dict(attributes), search).title_list
+        lookups = search.music_db.lookups
+        self.assertEqual(playqueue.PlayQueue(dict(attributes), search).title_list, title_list)
+        self.assertEqual(search.music_db.lookups, lookups)
+
+class StoreTest(unittest.TestCase):
+    """ PlayQueueStore の保存 """
+    def store(self, adapter):
+        """ 再生中のキューを持つ PlayQueueStore """
+        manager = FakeAttributesManager({'play_queue': queue_attributes(), 'volume': 3})
+        return playqueue.PlayQueueStore(manager, FakeMusicSearch(['t1', 't2', 't3']),
+                                        adapter, 'envelope')
+
+    def test_changed_fields(self):
+        """ play_queue の中で変わったフィールドだけを返す """
+        store = self.store(FakeAdapter())
+        self.assertEqual(store.changed_fields(), set())
+        store.attributes['play_queue']['index'] = 1
+        store.attributes['play_queue'].pop('state')
+        self.assertEqual(store.changed_fields(), {'index', 'state'})
+
+    def test_changed_fields_whole_item(self):
+        """ play_queue の外が変わったり、キューが入れ替わったら None """
+        store = self.store(FakeAdapter())
+        store.attributes['volume'] = 4
+        self.assertIsNone(store.changed_fields())
+        store = self.store(FakeAdapter())
+        store.set_play_queue({})
+        self.assertIsNone(store.changed_fields())
+
+    def test_save_skips_unchanged(self):
+        """ 何も変わっていなければ書かない """
+        adapter = FakeAdapter()
+        store = self.store(adapter)
+        store.save()
+        self.assertEqual((adapter.calls, store.attributes_manager.saves), ([], 0))
+        self.assertEqual(store.stats['skipped'], 1)
+
+    def test_save_updates_playback_fields(self):
+        """ 再生位置だけの変更は、渡されたアダプタと envelope で UpdateItem する """
+        adapter = FakeAdapter()
+        store = self.store(adapter)
+        store.get_play_queue()['index'] = 2
+        store.save()
+        self.assertEqual(adapter.calls, [('envelope', 'play_queue', {'index': 2}, [], playqueue.PLAYBACK_FIELDS)])
+        self.assertEqual(store.attributes_manager.saves, 0)
+        # 書いた後は、その値が比べる元になる
+        store.save()
+        self.assertEqual(len(adapter.calls), 1)
+
+    def test_save_whole_item(self):
+        """ 再生位置以外の変更や、update_attributes で書けない時は item を丸ごと書く """
+        adapter = FakeAdapter()
+        store = self.store(adapter)
+        store.get_play_queue()['seed'] = 5
+        store.save()
+        self.assertEqual((adapter.calls, store.attributes_manager.saves), ([], 1))
+
+        for adapter in [FakeAdapter(result=False), None]:
+            store = self.store(adapter)
+            store.get_play_queue()['index'] = 2
+            store.save()
+            self.assertEqual(store.attributes_manager.saves, 1)
+
+if __name__ == '__main__':
+    unittest.main()